@@ -1,5 +1,6 @@
 # bot_full.py
 import os
+import atexit
 import sys
 import time
 import threading
@@ -7,21 +8,37 @@ import json
 import smtplib
 import pickle
 import io
+import gzip
 import sqlite3
 import requests
 import urllib3
 import uuid
 import hashlib
+import secrets
+import httplib2
+import copy
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.policy import compat32
 import telebot
 from telebot import types
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Отключаем предупреждения SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -32,16 +49,52 @@ SCREENSHOTS_FOLDER = "Screenshots"
 PC_COMMANDS_FILE = "pc_commands.json"
 PC_STATUS_FILE = "pc_status.json"
 CHATS_DB_FILE = "chats.db"
+CHATS_DELTA_PREFIX = "chats_delta_"
 DELAYED_TASKS_FILE = "delayed_tasks.json"
+EMAIL_OUTBOX_FILE = "email_outbox.json"
 SCOPES = ['https://www.googleapis.com/auth/drive']
 TOKEN_FILE = "token.pickle"
+TOKEN_REFRESH_MARGIN = 300  # обновлять токен Google Drive за 5 минут до истечения
 CREDENTIALS_FILE = "client_secrets.json"
+DRIVE_INDEX_FILE = "drive_index.json"
+DRIVE_CHANGES_FILE = "drive_changes.json"
 CONFIG_FILE = "config.json"
 EMAILS_FILE = "emails.json"
 SETTINGS_FILE = "settings.json"
 AUTH_USERS_FILE = "auth_users.json"
 PLATON_APP_FILE = "platon_app_settings.json"
 PLATON_TOKENS_FILE = "platon_tokens.json"
+STATE_DB_FILE = "state.db"
+JOURNAL_DIR = "journal"
+# Файлы, которые читает только бот: для них допустим компактный формат STATE_FILE_ENCODING
+# (platon_tokens.json читает веб-приложение MAX_APP, поэтому он всегда в обычном JSON)
+COMPACT_STATE_FILES = (EMAILS_FILE, AUTH_USERS_FILE, SETTINGS_FILE, DELAYED_TASKS_FILE)
+STATE_SNAPSHOT_INTERVAL = 60  # секунд между снимками локального состояния в Google Drive
+JSON_CACHE_TTL = 30  # секунд до повторной проверки ревизии файла в Drive
+DRIVE_BATCH_LIMIT = 100  # максимум запросов в одном batch-запросе Drive API
+DRIVE_CHANGES_INTERVAL = 15  # секунд между опросами ленты изменений Google Drive
+JSON_FLUSH_DEBOUNCE = 2  # секунд, за которые записи одного JSON файла объединяются в одну загрузку
+JSON_CAS_RETRIES = 3  # попыток записи при одновременном изменении файла другим процессом
+JSON_FLUSH_MAX_BACKOFF = 300  # секунд: предельная пауза между повторами неудавшейся загрузки
+SCHEDULER_WORKERS = 4  # потоков, выполняющих наступившие отложенные задачи
+SCHEDULER_BATCH_WINDOW = 1  # секунд: задачи, наступающие в этом окне, выполняются и сохраняются одной пачкой
+SCHEDULER_COMMIT_DELAY = 2  # секунд, не дольше которых готовый результат задачи ждет остальных задач пачки
+OVERDUE_STAGGER_INTERVAL = 10  # секунд между запусками просроченных задач при политике "stagger"
+SMTP_MAX_SESSIONS = 3  # одновременных SMTP сессий
+SMTP_IDLE_TIMEOUT = 60  # секунд, после которых свободная SMTP сессия не переиспользуется
+BROADCAST_WORKERS = SMTP_MAX_SESSIONS  # потоков, отправляющих письма рассылки
+BROADCAST_PROGRESS_INTERVAL = 5  # секунд между обновлениями сообщения о ходе рассылки
+EMAIL_RATE_MAX_WAIT = 60  # секунд ожидания лимита, после которых попытка отправки считается неудачной
+EMAIL_MAX_ATTEMPTS = 5  # попыток доставки письма при временных ошибках SMTP
+EMAIL_RETRY_DELAY = 30  # секунд до повторной попытки (удваивается с каждой попыткой)
+TOKEN_LIFETIME = 24 * 3600  # секунд действия ссылки на MAX_APP
+TOKEN_EXPIRY_BATCH = 5  # секунд, за которые истекшие токены удаляются одной записью
+CHATS_DB_COMPACT_DELTAS = 50  # файлов изменений chats.db, после которых выгружается полный снимок
+CHATS_DB_SYNC_INTERVAL = 10  # секунд, за которые изменения chats.db объединяются в одну выгрузку
+JOURNAL_COMPACT_EVENTS = 100  # событий журнала, после которых он переносится в снимок
+JOURNAL_COMPACT_INTERVAL = 60  # секунд между плановыми компактизациями журнала
+RETENTION_INTERVAL = 24 * 3600  # секунд между проходами архивации старых записей
+RETENTION_STARTUP_DELAY = 5 * 60  # секунд после запуска до первого прохода архивации
 
 # Инициализация бота
 bot = None
@@ -56,6 +109,17 @@ PASSWORD_PLATON = None
 OPENROUTER_KEY = None
 EMAIL_SENDER = None
 EMAIL_PASSWORD = None
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 587
+SMTP_STARTTLS = True  # False - для локального SMTP сервера без TLS (например, при проверке рассылок)
+EMAIL_RATE_PER_SECOND = 2  # лимиты отправки писем (0 - без ограничения)
+EMAIL_RATE_PER_MINUTE = 60
+EMAIL_RATE_PER_DAY = 2000
+STATE_BACKEND = "drive"  # "drive" или "sqlite"
+STATE_FILE_ENCODING = "json"  # "json", "json-min", "json-gz" или "msgpack-gz"
+OVERDUE_TASK_POLICY = "stagger"  # просроченные при перезапуске задачи: "run", "stagger" или "drop"
+OVERDUE_GRACE_PERIOD = 6 * 3600  # секунд: задачи, просроченные сильнее, не выполняются ни при какой политике
+RETENTION_DAYS = 30  # через сколько дней выполненные задачи и команды ПК уходят в архив
 
 # Временные данные
 selected_chats = {}
@@ -76,6 +140,26 @@ DELAY_TIMES = {
 }
 
 # ========== СИСТЕМА БЕЗОПАСНОСТИ ВЕБ-ПРИЛОЖЕНИЯ ==========
+# Токены MAX_APP проверяет внешнее веб-приложение по записям platon_tokens.json, поэтому каждый
+# выданный токен сохраняется в прежнем формате. Бот держит в памяти только кучу
+# (время истечения, token): каждый токен удаляется из хранилища в момент истечения,
+# без периодического перебора всего файла
+token_expiry_heap = []
+token_expiry_lock = threading.Lock()
+token_expiry_changed = threading.Event()
+
+def load_token_expiry_index():
+    """Строит кучу времен истечения по сохраненным токенам"""
+    stored_tokens = state_backend.get_tokens()
+    
+    with token_expiry_lock:
+        token_expiry_heap.clear()
+        for token, token_data in stored_tokens.items():
+            expires = datetime.fromisoformat(token_data.get("expires_at", "2000-01-01")).timestamp()
+            token_expiry_heap.append((expires, token))
+        heapq.heapify(token_expiry_heap)
+    token_expiry_changed.set()
+
 def generate_secure_token(user_id):
     """Генерирует защищенный токен с временем жизни"""
     unique_id = str(uuid.uuid4())
@@ -106,9 +190,7 @@ def verify_secure_token(token):
         except ValueError:
             return False
         
-        current_time = int(time.time())
-        if current_time - timestamp > 86400:
-            delete_platon_token(token)
+        if int(time.time()) - timestamp > TOKEN_LIFETIME:
             return False
         
         secret_salt = "EGENIUS_SECURE_SALT_v2"
@@ -118,23 +200,19 @@ def verify_secure_token(token):
         if received_hash != expected_hash:
             return False
         
-        token_data = get_platon_token(token)
-        if not token_data:
-            return False
-        
-        if token_data["user_id"] != user_id:
-            return False
-        
-        if token_data.get("used", False):
+        token_data = state_backend.get_tokens().get(token)
+        if not token_data or token_data["user_id"] != user_id or token_data.get("used", False):
             return False
         
         if not is_platon_app_enabled():
             return False
         
-        mark_token_as_used(token)
+        token_data["used"] = True
+        token_data["used_at"] = datetime.now().isoformat()
+        state_backend.save_token(token, token_data)
         
         return user_id
-        
+    
     except Exception as e:
         print(f"❌ Ошибка проверки токена: {e}")
         return False
@@ -142,64 +220,31 @@ def verify_secure_token(token):
 def save_platon_token(token, user_id):
     """Сохраняет токен в базе"""
     try:
-        tokens_data = load_json_file(PLATON_TOKENS_FILE, {"tokens": {}})
-        
-        tokens_data["tokens"][token] = {
+        created_at = datetime.now()
+        expires_at = created_at + timedelta(seconds=TOKEN_LIFETIME)
+        saved = state_backend.save_token(token, {
             "user_id": user_id,
-            "created_at": datetime.now().isoformat(),
-            "expires_at": (datetime.now() + timedelta(hours=24)).isoformat(),
+            "created_at": created_at.isoformat(),
+            "expires_at": expires_at.isoformat(),
             "used": False
-        }
+        })
         
-        save_json_file(PLATON_TOKENS_FILE, tokens_data)
-        return True
+        with token_expiry_lock:
+            heapq.heappush(token_expiry_heap, (expires_at.timestamp(), token))
+            if token_expiry_heap[0][1] == token:
+                token_expiry_changed.set()
+        return saved
     except Exception as e:
         print(f"❌ Ошибка сохранения токена: {e}")
         return False
 
-def get_platon_token(token):
-    """Получает информацию о токене"""
-    try:
-        tokens_data = load_json_file(PLATON_TOKENS_FILE, {"tokens": {}})
-        return tokens_data.get("tokens", {}).get(token)
-    except Exception as e:
-        print(f"❌ Ошибка получения токена: {e}")
-        return None
-
-def mark_token_as_used(token):
-    """Помечает токен как использованный"""
-    try:
-        tokens_data = load_json_file(PLATON_TOKENS_FILE, {"tokens": {}})
-        
-        if token in tokens_data.get("tokens", {}):
-            tokens_data["tokens"][token]["used"] = True
-            tokens_data["tokens"][token]["used_at"] = datetime.now().isoformat()
-            save_json_file(PLATON_TOKENS_FILE, tokens_data)
-            return True
-        return False
-    except Exception as e:
-        print(f"❌ Ошибка отметки токена: {e}")
-        return False
-
-def delete_platon_token(token):
-    """Удаляет токен"""
-    try:
-        tokens_data = load_json_file(PLATON_TOKENS_FILE, {"tokens": {}})
-        
-        if token in tokens_data.get("tokens", {}):
-            del tokens_data["tokens"][token]
-            save_json_file(PLATON_TOKENS_FILE, tokens_data)
-            return True
-        return False
-    except Exception as e:
-        print(f"❌ Ошибка удаления токена: {e}")
-        return False
-
 def revoke_all_platon_tokens():
     """Аннулирует ВСЕ токены доступа"""
     try:
-        tokens_data = {"tokens": {}, "revoked_at": datetime.now().isoformat()}
-        save_json_file(PLATON_TOKENS_FILE, tokens_data)
+        with token_expiry_lock:
+            token_expiry_heap.clear()
+        
+        state_backend.revoke_tokens(datetime.now().isoformat())
         log_event("TOKENS_REVOKED", "admin", "All tokens revoked")
         return True
     except Exception as e:
@@ -207,31 +252,33 @@ def revoke_all_platon_tokens():
         return False
 
 def cleanup_expired_tokens():
-    """Очищает просроченные токены"""
+    """Удаляет истекшие токены (из кучи по времени истечения) и возвращает их количество"""
     try:
-        tokens_data = load_json_file(PLATON_TOKENS_FILE, {"tokens": {}})
-        current_time = datetime.now()
-        expired_count = 0
-        
-        tokens_to_delete = []
-        
-        for token, token_data in tokens_data.get("tokens", {}).items():
-            expires_at = datetime.fromisoformat(token_data.get("expires_at", "2000-01-01"))
-            if current_time > expires_at:
-                tokens_to_delete.append(token)
-        
-        for token in tokens_to_delete:
-            del tokens_data["tokens"][token]
-            expired_count += 1
-        
-        if expired_count > 0:
-            save_json_file(PLATON_TOKENS_FILE, tokens_data)
-        
-        return expired_count
+        now = time.time()
+        expired = []
+        with token_expiry_lock:
+            while token_expiry_heap and token_expiry_heap[0][0] <= now:
+                expires, token = heapq.heappop(token_expiry_heap)
+                expired.append(token)
+        
+        if expired:
+            state_backend.delete_tokens(expired)
+        return len(expired)
     except Exception as e:
         print(f"❌ Ошибка очистки токенов: {e}")
         return 0
 
+def token_expiry_scheduler():
+    """Фоновый поток: удаляет токены по мере истечения (пачками не чаще раза в TOKEN_EXPIRY_BATCH секунд)"""
+    while True:
+        with token_expiry_lock:
+            next_expiry = token_expiry_heap[0][0] if token_expiry_heap else time.time() + TOKEN_LIFETIME
+        
+        token_expiry_changed.wait(max(next_expiry - time.time(), 0))
+        token_expiry_changed.clear()
+        time.sleep(TOKEN_EXPIRY_BATCH)
+        cleanup_expired_tokens()
+
 # ========== ЛОГГИРОВАНИЕ ==========
 def log_event(event_type, user_id, details=""):
     """Логирует события в консоль"""
@@ -252,8 +299,15 @@ def log_event(event_type, user_id, details=""):
     print(log_message)
 
 # ========== GOOGLE DRIVE ФУНКЦИИ ==========
-def get_drive_service():
-    """Создает сервис для работы с Google Drive"""
+# Учетные данные общие для процесса, сервис (и его httplib2 транспорт) - свой у каждого потока
+drive_credentials = None
+drive_credentials_lock = threading.Lock()
+drive_discovery_doc = None
+drive_thread_local = threading.local()
+drive_refresher_started = False
+
+def load_drive_credentials():
+    """Загружает и при необходимости обновляет учетные данные Google Drive"""
     creds = None
     
     if os.path.exists(TOKEN_FILE):
@@ -283,13 +337,92 @@ def get_drive_service():
             except Exception as e:
                 print(f"❌ Ошибка авторизации: {e}")
                 return None
-            
-            with open(TOKEN_FILE, 'wb') as token:
-                pickle.dump(creds, token)
-                print("✅ Токен сохранен")
+        
+        save_drive_credentials(creds)
+    
+    return creds
+
+def save_drive_credentials(creds):
+    """Сохраняет учетные данные Google Drive в файл токена"""
+    try:
+        with open(TOKEN_FILE, 'wb') as token:
+            pickle.dump(creds, token)
+        print("✅ Токен сохранен")
+    except Exception as e:
+        print(f"⚠️ Ошибка сохранения токена: {e}")
+
+def get_drive_credentials():
+    """Возвращает общие для процесса учетные данные Google Drive"""
+    global drive_credentials
+    if drive_credentials is None:
+        with drive_credentials_lock:
+            if drive_credentials is None:
+                drive_credentials = load_drive_credentials()
+    return drive_credentials
+
+def refresh_drive_credentials():
+    """Обновляет токен, если до его истечения осталось меньше TOKEN_REFRESH_MARGIN"""
+    creds = get_drive_credentials()
+    if not creds or not creds.refresh_token:
+        return
+    
+    with drive_credentials_lock:
+        if creds.expiry and (creds.expiry - datetime.utcnow()).total_seconds() > TOKEN_REFRESH_MARGIN:
+            return
+        try:
+            creds.refresh(Request())
+            save_drive_credentials(creds)
+        except Exception as e:
+            print(f"⚠️ Ошибка фонового обновления токена: {e}")
+
+def drive_token_refresher():
+    """Фоново обновляет токен Google Drive до его истечения"""
+    while True:
+        refresh_drive_credentials()
+        
+        creds = drive_credentials
+        if creds and creds.expiry:
+            seconds_left = (creds.expiry - datetime.utcnow()).total_seconds() - TOKEN_REFRESH_MARGIN
+            time.sleep(min(max(seconds_left, 30), 3600))
+        else:
+            time.sleep(3600)
+
+def start_drive_token_refresher():
+    """Запускает фоновое обновление токена (один раз на процесс)"""
+    global drive_refresher_started
+    with drive_credentials_lock:
+        if drive_refresher_started:
+            return
+        drive_refresher_started = True
+    threading.Thread(target=drive_token_refresher, daemon=True).start()
+
+def build_drive_service(creds):
+    """Создает сервис Google Drive по встроенному discovery-документу"""
+    global drive_discovery_doc
+    http = AuthorizedHttp(creds, http=httplib2.Http())
+    
+    if drive_discovery_doc is None:
+        static_doc = get_static_doc('drive', 'v3')
+        if static_doc:
+            drive_discovery_doc = json.loads(static_doc)
+    
+    if drive_discovery_doc:
+        return build_from_document(drive_discovery_doc, http=http)
+    return build('drive', 'v3', http=http, cache_discovery=False)
+
+def get_drive_service():
+    """Возвращает сервис для работы с Google Drive (свой для каждого потока)"""
+    service = getattr(drive_thread_local, 'service', None)
+    if service is not None:
+        return service
+    
+    creds = get_drive_credentials()
+    if not creds:
+        return None
     
     try:
-        service = build('drive', 'v3', credentials=creds)
+        service = build_drive_service(creds)
+        drive_thread_local.service = service
         return service
     except Exception as e:
         print(f"❌ Ошибка создания сервиса: {e}")
@@ -321,23 +454,142 @@ def get_or_create_folder(service, folder_name, parent_id=None):
         print(f"❌ Ошибка поиска/создания папки: {e}")
         return None
 
+# ========== ИНДЕКС ФАЙЛОВ GOOGLE DRIVE ==========
+# folder_id -> {file_name: file_id}, хранится локально в DRIVE_INDEX_FILE
+drive_file_index = {}
+drive_index_lock = threading.Lock()
+
+def load_drive_index():
+    """Загружает локальный индекс имен файлов Google Drive"""
+    global drive_file_index
+    if not os.path.exists(DRIVE_INDEX_FILE):
+        return
+    
+    try:
+        with open(DRIVE_INDEX_FILE, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        with drive_index_lock:
+            drive_file_index = index
+        print(f"✅ Индекс файлов Google Drive загружен ({sum(len(v) for v in index.values())} файлов)")
+    except Exception as e:
+        print(f"⚠️ Ошибка загрузки индекса файлов: {e}")
+
+def save_drive_index():
+    """Сохраняет индекс имен файлов Google Drive на диск"""
+    try:
+        with drive_index_lock:
+            content = json.dumps(drive_file_index, indent=2, ensure_ascii=False)
+        temp_file = f"{DRIVE_INDEX_FILE}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_file, DRIVE_INDEX_FILE)
+    except Exception as e:
+        print(f"⚠️ Ошибка сохранения индекса файлов: {e}")
+
+def remember_drive_files(folder_id, files):
+    """Добавляет файлы (список {'id', 'name'}) в индекс папки"""
+    changed = False
+    with drive_index_lock:
+        folder_index = drive_file_index.setdefault(folder_id, {})
+        for file in files:
+            if folder_index.get(file['name']) != file['id']:
+                folder_index[file['name']] = file['id']
+                changed = True
+    
+    if changed:
+        save_drive_index()
+
+def forget_drive_file(folder_id, file_name):
+    """Удаляет устаревшую запись из индекса"""
+    with drive_index_lock:
+        removed = drive_file_index.get(folder_id, {}).pop(file_name, None)
+    
+    if removed:
+        save_drive_index()
+
+def index_drive_folder(service, folder_id):
+    """Заполняет индекс папки одним проходом по ее содержимому"""
+    with drive_index_lock:
+        if folder_id in drive_file_index:
+            return
+    
+    query = f"'{folder_id}' in parents and trashed=false"
+    files = {}
+    page_token = None
+    while True:
+        results = service.files().list(q=query, fields='nextPageToken, files(id, name)',
+                                       pageSize=1000, pageToken=page_token).execute()
+        for file in results.get('files', []):
+            files.setdefault(file['name'], file['id'])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    
+    with drive_index_lock:
+        drive_file_index[folder_id] = files
+    save_drive_index()
+    print(f"✅ Проиндексировано файлов в папке: {len(files)}")
+
+def find_drive_file_id(service, file_name, folder_id):
+    """Возвращает id файла по имени: из индекса или поиском в Drive"""
+    with drive_index_lock:
+        file_id = drive_file_index.get(folder_id, {}).get(file_name)
+    if file_id:
+        return file_id
+    
+    query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
+    results = service.files().list(q=query, fields='files(id, name)').execute()
+    files = results.get('files', [])
+    if not files:
+        return None
+    
+    remember_drive_files(folder_id, files[:1])
+    return files[0]['id']
+
+def list_indexed_drive_files(folder_id, prefix):
+    """Возвращает отсортированные имена файлов папки из индекса, начинающиеся с prefix"""
+    with drive_index_lock:
+        return sorted(name for name in drive_file_index.get(folder_id, {}) if name.startswith(prefix))
+
+def call_with_drive_file_id(service, file_name, folder_id, action):
+    """Вызывает action(file_id); при устаревшем id в индексе ищет файл заново"""
+    file_id = find_drive_file_id(service, file_name, folder_id)
+    if not file_id:
+        return None
+    
+    try:
+        return action(file_id)
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+    
+    forget_drive_file(folder_id, file_name)
+    file_id = find_drive_file_id(service, file_name, folder_id)
+    return action(file_id) if file_id else None
+
+def upload_file_to_drive(service, file_name, binary_content, folder_id, mime_type='application/octet-stream'):
+    """Загружает содержимое файла в Google Drive и возвращает его метаданные"""
+    def update_file(file_id):
+        media = MediaIoBaseUpload(io.BytesIO(binary_content), mimetype=mime_type)
+        return service.files().update(fileId=file_id, media_body=media,
+                                      fields='id, headRevisionId, md5Checksum').execute()
+    
+    file = call_with_drive_file_id(service, file_name, folder_id, update_file)
+    if file:
+        return file
+    
+    file_metadata = {'name': file_name, 'parents': [folder_id]}
+    media = MediaIoBaseUpload(io.BytesIO(binary_content), mimetype=mime_type)
+    file = service.files().create(body=file_metadata, media_body=media,
+                                  fields='id, headRevisionId, md5Checksum').execute()
+    remember_drive_files(folder_id, [{'id': file['id'], 'name': file_name}])
+    return file
+
 def save_file_to_drive(service, file_name, content, folder_id, mime_type='application/json'):
     """Сохраняет файл в Google Drive"""
     try:
-        query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-        results = service.files().list(q=query, fields='files(id, name)').execute()
-        files = results.get('files', [])
-        
-        if files:
-            file_id = files[0]['id']
-            media = MediaIoBaseUpload(io.BytesIO(content.encode('utf-8')), mimetype=mime_type)
-            service.files().update(fileId=file_id, media_body=media).execute()
-            return file_id
-        else:
-            file_metadata = {'name': file_name, 'parents': [folder_id]}
-            media = MediaIoBaseUpload(io.BytesIO(content.encode('utf-8')), mimetype=mime_type)
-            file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-            return file.get('id')
+        file = upload_file_to_drive(service, file_name, content.encode('utf-8'), folder_id, mime_type)
+        return file.get('id')
     except Exception as e:
         print(f"⚠️ Ошибка сохранения файла {file_name}: {e}")
         return None
@@ -345,42 +597,63 @@ def save_file_to_drive(service, file_name, content, folder_id, mime_type='applic
 def save_binary_file_to_drive(service, file_name, binary_content, folder_id, mime_type='application/octet-stream'):
     """Сохраняет бинарный файл в Google Drive"""
     try:
-        query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-        results = service.files().list(q=query, fields='files(id, name)').execute()
-        files = results.get('files', [])
-        
-        if files:
-            file_id = files[0]['id']
-            media = MediaIoBaseUpload(io.BytesIO(binary_content), mimetype=mime_type)
-            service.files().update(fileId=file_id, media_body=media).execute()
-            return file_id
-        else:
-            file_metadata = {'name': file_name, 'parents': [folder_id]}
-            media = MediaIoBaseUpload(io.BytesIO(binary_content), mimetype=mime_type)
-            file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-            return file.get('id')
+        file = upload_file_to_drive(service, file_name, binary_content, folder_id, mime_type)
+        return file.get('id')
     except Exception as e:
         print(f"⚠️ Ошибка сохранения бинарного файла {file_name}: {e}")
         return None
 
+def delete_drive_file(service, file_name, folder_id):
+    """Удаляет файл из Google Drive и из индекса"""
+    call_with_drive_file_id(service, file_name, folder_id,
+                            lambda file_id: service.files().delete(fileId=file_id).execute())
+    forget_drive_file(folder_id, file_name)
+
+def get_drive_file_meta(service, file_name, folder_id):
+    """Получает id и ревизию файла в Google Drive (None, если файла нет)"""
+    return call_with_drive_file_id(
+        service, file_name, folder_id,
+        lambda file_id: service.files().get(fileId=file_id, fields='id, name, headRevisionId, md5Checksum').execute()
+    )
+
+def batch_get_drive_files_meta(service, file_ids, fields='id, name, size, headRevisionId, md5Checksum'):
+    """Получает метаданные нескольких файлов batch-запросами (file_id -> метаданные или None, если файла нет)"""
+    results = {}
+    
+    def callback(request_id, response, exception):
+        if exception is None:
+            results[request_id] = response
+        elif isinstance(exception, HttpError) and exception.resp.status == 404:
+            results[request_id] = None
+        else:
+            print(f"⚠️ Ошибка получения метаданных файла {request_id}: {exception}")
+    
+    file_ids = list(file_ids)
+    for start in range(0, len(file_ids), DRIVE_BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=callback)
+        for file_id in file_ids[start:start + DRIVE_BATCH_LIMIT]:
+            batch.add(service.files().get(fileId=file_id, fields=fields), request_id=file_id)
+        batch.execute()
+    
+    return results
+
+def download_drive_file(service, file_id):
+    """Скачивает содержимое файла из Google Drive по его id"""
+    request = service.files().get_media(fileId=file_id)
+    file_content = io.BytesIO()
+    downloader = MediaIoBaseDownload(file_content, request)
+    done = False
+    while not done:
+        status, done = downloader.next_chunk()
+    
+    return file_content.getvalue()
+
 def load_file_from_drive(service, file_name, folder_id):
     """Загружает файл из Google Drive"""
     try:
-        query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-        results = service.files().list(q=query, fields='files(id, name)').execute()
-        files = results.get('files', [])
-        
-        if files:
-            file_id = files[0]['id']
-            request = service.files().get_media(fileId=file_id)
-            file_content = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_content, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            
-            return file_content.getvalue().decode('utf-8')
-        return None
+        content = call_with_drive_file_id(service, file_name, folder_id,
+                                          lambda file_id: download_drive_file(service, file_id))
+        return content.decode('utf-8') if content is not None else None
     except Exception as e:
         print(f"⚠️ Ошибка загрузки файла {file_name}: {e}")
         return None
@@ -388,69 +661,1449 @@ def load_file_from_drive(service, file_name, folder_id):
 def load_binary_file_from_drive(service, file_name, folder_id):
     """Загружает бинарный файл из Google Drive"""
     try:
-        query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-        results = service.files().list(q=query, fields='files(id, name)').execute()
-        files = results.get('files', [])
-        
-        if files:
-            file_id = files[0]['id']
-            request = service.files().get_media(fileId=file_id)
-            file_content = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_content, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            
-            return file_content.getvalue()
-        return None
+        return call_with_drive_file_id(service, file_name, folder_id,
+                                       lambda file_id: download_drive_file(service, file_id))
     except Exception as e:
         print(f"⚠️ Ошибка загрузки бинарного файла {file_name}: {e}")
         return None
 
+# ========== КЭШ JSON ФАЙЛОВ ==========
+# filename -> {"data": ..., "revision": ..., "md5": ..., "checked_at": ..., "dirty": ...}
+json_cache = {}
+json_cache_lock = threading.Lock()
+
+def cache_json_file(filename, data, file_meta):
+    """Кладет содержимое JSON файла в кэш вместе с его ревизией в Drive"""
+    with json_cache_lock:
+        json_cache[filename] = {
+            "data": copy.deepcopy(data),
+            "revision": file_meta.get("headRevisionId"),
+            "md5": file_meta.get("md5Checksum"),
+            "checked_at": time.time(),
+            "dirty": False
+        }
+
+def invalidate_json_cache(filename, file_meta=None):
+    """Удаляет файл из кэша, если в Drive появилась другая ревизия (несохраненные записи не трогает)"""
+    if filename == AUTH_USERS_FILE:
+        invalidate_auth_roles()
+    elif filename in JOURNAL_COLLECTIONS:
+        invalidate_journaled_index(filename)
+    
+    with json_cache_lock:
+        entry = json_cache.get(filename)
+        if not entry or entry["dirty"]:
+            return
+        if file_meta is None or not is_cached_revision(entry, file_meta):
+            del json_cache[filename]
+
+def encode_json_content(filename, data):
+    """Кодирует данные файла согласно STATE_FILE_ENCODING, возвращает (bytes, mime_type)"""
+    if filename not in COMPACT_STATE_FILES or STATE_FILE_ENCODING == "json":
+        return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8'), 'application/json'
+    
+    if STATE_FILE_ENCODING == "msgpack-gz" and msgpack is not None:
+        return gzip.compress(msgpack.packb(data, use_bin_type=True), mtime=0), 'application/gzip'
+    
+    content = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    if STATE_FILE_ENCODING == "json-min":
+        return content, 'application/json'
+    return gzip.compress(content, mtime=0), 'application/gzip'
+
+def decode_json_content(content):
+    """Декодирует файл состояния любого поддерживаемого формата (JSON, gzip, MessagePack)"""
+    if content[:2] == b'\x1f\x8b':
+        content = gzip.decompress(content)
+    
+    try:
+        return json.loads(content.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        if msgpack is None:
+            raise ValueError("файл в формате MessagePack, но модуль msgpack не установлен")
+        return msgpack.unpackb(content, raw=False, strict_map_key=False)
+
+def is_cached_revision(entry, file_meta):
+    """Проверяет, совпадает ли закэшированная версия с файлом в Drive"""
+    if entry["revision"] and file_meta.get("headRevisionId"):
+        return entry["revision"] == file_meta["headRevisionId"]
+    return bool(entry["md5"]) and entry["md5"] == file_meta.get("md5Checksum")
+
 # ========== РАБОТА С ФАЙЛАМИ В GOOGLE DRIVE ==========
-def load_json_file(filename, default_data):
-    """Загружает JSON файл из Google Drive"""
+def load_json_file(filename, default_data, create_missing=True, strict=False):
+    """Загружает JSON файл из Google Drive (через кэш в памяти; create_missing - создать отсутствующий файл,
+    strict - вернуть None вместо default_data, если файл не удалось прочитать)"""
+    with json_cache_lock:
+        entry = json_cache.get(filename)
+        if entry and (entry["dirty"] or is_drive_changes_active()
+                      or time.time() - entry["checked_at"] < JSON_CACHE_TTL):
+            return copy.deepcopy(entry["data"])
+    
     service = get_drive_service()
     if not service or not GOOGLE_DRIVE_FOLDER_ID:
-        return default_data
+        return None if strict else default_data
+    
+    try:
+        file_meta = get_drive_file_meta(service, filename, GOOGLE_DRIVE_FOLDER_ID)
+        
+        if file_meta and entry and is_cached_revision(entry, file_meta):
+            with json_cache_lock:
+                entry["checked_at"] = time.time()
+                return copy.deepcopy(entry["data"])
+        
+        content = download_drive_file(service, file_meta['id']) if file_meta else None
+    except Exception as e:
+        print(f"⚠️ Ошибка загрузки файла {filename}: {e}")
+        if entry:
+            return copy.deepcopy(entry["data"])
+        return None if strict else default_data
     
-    content = load_file_from_drive(service, filename, GOOGLE_DRIVE_FOLDER_ID)
     if content:
         try:
-            return json.loads(content)
+            data = decode_json_content(content)
         except:
-            return default_data
+            return None if strict else default_data
+        cache_json_file(filename, data, file_meta)
+        return copy.deepcopy(data)
     else:
-        save_json_file(filename, default_data)
+        if create_missing:
+            save_json_file(filename, default_data)
         return default_data
 
 def save_json_file(filename, data):
-    """Сохраняет JSON файл в Google Drive"""
-    service = get_drive_service()
-    if not service or not GOOGLE_DRIVE_FOLDER_ID:
+    """Сохраняет JSON файл в Google Drive целиком (через отложенную запись)"""
+    return queue_json_write(filename, data, ("set", copy.deepcopy(data)))
+
+def update_json_file(filename, default_data, mutate):
+    """Изменяет JSON файл: mutate(data) меняет данные на месте и возвращает True, если их нужно сохранить"""
+    with get_json_file_lock(filename):
+        data = load_json_file(filename, default_data, strict=True)
+        if data is None:
+            # Изменение поверх значения по умолчанию затерло бы файл в Drive
+            return False
+        data = normalize_json_data(data, default_data)
+        if not mutate(data):
+            return False
+        return queue_json_write(filename, data, ("update", mutate, default_data))
+
+# ========== БЛОКИРОВКИ И ОПТИМИСТИЧНАЯ ЗАПИСЬ JSON ФАЙЛОВ ==========
+# Потоки бота изменяют один файл по очереди (блокировка на файл), а запись в Drive
+# проверяет headRevisionId: если файл изменил другой процесс, изменения переигрываются
+# поверх его версии
+json_file_locks = {}
+json_file_locks_guard = threading.Lock()
+
+def get_json_file_lock(filename):
+    """Возвращает блокировку для изменения файла внутри процесса"""
+    with json_file_locks_guard:
+        if filename not in json_file_locks:
+            json_file_locks[filename] = threading.RLock()
+        return json_file_locks[filename]
+
+def normalize_json_data(data, default_data):
+    """Приводит данные к структуре default_data (неверный тип - значение по умолчанию)"""
+    if not isinstance(data, type(default_data)):
+        return copy.deepcopy(default_data)
+    if isinstance(data, dict):
+        for key, value in default_data.items():
+            if not isinstance(data.get(key), type(value)) and value is not None:
+                data[key] = copy.deepcopy(value)
+    return data
+
+def replay_json_ops(data, ops):
+    """Применяет накопленные изменения к другой версии файла"""
+    for op in ops:
+        if op[0] == "set":
+            data = copy.deepcopy(op[1])
+        else:
+            data = normalize_json_data(data, op[2])
+            op[1](data)
+    return data
+
+def upload_json_with_cas(service, filename, pending):
+    """Загружает отложенную запись, если ревизия в Drive не изменилась, иначе переигрывает изменения"""
+    data = pending["data"]
+    content = pending["content"]
+    mime_type = pending["mime_type"]
+    base_revision = pending["base_revision"]
+    rebased = False
+    
+    for attempt in range(JSON_CAS_RETRIES):
+        # Без известной ревизии (файла не было в кэше) запись тоже идет поверх версии из Drive, если она есть
+        remote_meta = get_drive_file_meta(service, filename, GOOGLE_DRIVE_FOLDER_ID)
+        if remote_meta and remote_meta.get("headRevisionId") != base_revision:
+            print(f"🔄 {filename} изменен другим процессом, применяю изменения поверх новой версии")
+            try:
+                remote_data = decode_json_content(download_drive_file(service, remote_meta['id']))
+            except ValueError:
+                remote_data = None
+            data = replay_json_ops(remote_data, pending["ops"])
+            content, mime_type = encode_json_content(filename, data)
+            base_revision = remote_meta.get("headRevisionId")
+            rebased = True
+            continue
+        
+        file_meta = upload_file_to_drive(service, filename, content, GOOGLE_DRIVE_FOLDER_ID, mime_type)
+        return file_meta, data, rebased
+    
+    raise RuntimeError(f"файл менялся во время каждой из {JSON_CAS_RETRIES} попыток записи")
+
+# ========== ОТЛОЖЕННАЯ ЗАПИСЬ JSON ФАЙЛОВ ==========
+# filename -> {"content": bytes, "mime_type": ..., "data": ..., "dirty_since": ..., "base_revision": ..., "ops": [...],
+#              "failures": ..., "retry_at": ...};
+# все сохранения файла за JSON_FLUSH_DEBOUNCE секунд уходят в Drive одной загрузкой последней версии
+pending_json_writes = {}
+json_flush_condition = threading.Condition()
+json_upload_lock = threading.Lock()
+json_flusher_started = False
+json_flush_stats = {"saves": 0, "uploads": 0, "failures": 0, "conflicts": 0, "last_latency": 0.0, "max_latency": 0.0}
+
+def queue_json_write(filename, data, op):
+    """Обновляет кэш и ставит файл в очередь на загрузку в Drive"""
+    if not GOOGLE_DRIVE_FOLDER_ID:
         return False
     
     try:
-        content = json.dumps(data, indent=2, ensure_ascii=False)
-        save_file_to_drive(service, filename, content, GOOGLE_DRIVE_FOLDER_ID)
-        return True
+        content, mime_type = encode_json_content(filename, data)
     except Exception as e:
         print(f"❌ Ошибка сохранения файла {filename}: {e}")
         return False
+    
+    with json_flush_condition:
+        with json_cache_lock:
+            entry = json_cache.get(filename) or {"revision": None, "md5": None}
+            json_cache[filename] = {
+                "data": copy.deepcopy(data),
+                "revision": entry["revision"],
+                "md5": entry["md5"],
+                "checked_at": time.time(),
+                "dirty": True
+            }
+        
+        pending = pending_json_writes.get(filename)
+        pending_json_writes[filename] = {
+            "content": content,
+            "mime_type": mime_type,
+            "data": copy.deepcopy(data),
+            "dirty_since": pending["dirty_since"] if pending else time.time(),
+            "base_revision": pending["base_revision"] if pending else entry["revision"],
+            "ops": (pending["ops"] if pending else []) + [op],
+            "failures": pending["failures"] if pending else 0,
+            "retry_at": pending["retry_at"] if pending else 0
+        }
+        json_flush_stats["saves"] += 1
+        json_flush_condition.notify()
+    
+    start_json_flusher()
+    return True
 
-# ========== СИСТЕМА ОТЛОЖЕННЫХ ЗАДАЧ ==========
-def load_delayed_tasks():
-    """Загружает отложенные задачи"""
-    return load_json_file(DELAYED_TASKS_FILE, {"tasks": []})
+def get_json_write_due_at(pending):
+    """Возвращает время, когда отложенную запись пора загружать (с учетом паузы после ошибок)"""
+    return max(pending["dirty_since"] + JSON_FLUSH_DEBOUNCE, pending["retry_at"])
+
+def flush_json_files(force=True):
+    """Загружает в Drive отложенные JSON файлы (force=False - только те, чье окно истекло)"""
+    with json_upload_lock:
+        with json_flush_condition:
+            now = time.time()
+            due = {filename: pending for filename, pending in pending_json_writes.items()
+                   if force or now >= get_json_write_due_at(pending)}
+            for filename in due:
+                del pending_json_writes[filename]
+        
+        if not due:
+            return
+        
+        service = get_drive_service()
+        for filename, pending in due.items():
+            started = time.time()
+            file_meta = None
+            try:
+                if service:
+                    file_meta, data, rebased = upload_json_with_cas(service, filename, pending)
+            except Exception as e:
+                print(f"❌ Ошибка сохранения файла {filename}: {e}")
+            latency = time.time() - started
+            
+            with json_flush_condition:
+                newer = pending_json_writes.get(filename)
+                if file_meta:
+                    json_flush_stats["uploads"] += 1
+                    json_flush_stats["conflicts"] += int(rebased)
+                    json_flush_stats["last_latency"] = latency
+                    json_flush_stats["max_latency"] = max(json_flush_stats["max_latency"], latency)
+                    with json_cache_lock:
+                        entry = json_cache.get(filename)
+                        if newer is None and entry:
+                            entry["data"] = copy.deepcopy(data)
+                            entry["revision"] = file_meta.get("headRevisionId")
+                            entry["md5"] = file_meta.get("md5Checksum")
+                            entry["checked_at"] = time.time()
+                            entry["dirty"] = False
+                        elif newer is not None and not rebased:
+                            # Новые изменения сделаны поверх только что загруженной версии
+                            newer["base_revision"] = file_meta.get("headRevisionId")
+                            if entry:
+                                entry["revision"] = file_meta.get("headRevisionId")
+                                entry["md5"] = file_meta.get("md5Checksum")
+                else:
+                    json_flush_stats["failures"] += 1
+                    if newer is None:
+                        newer = pending_json_writes[filename] = pending
+                    else:
+                        newer["ops"] = pending["ops"] + newer["ops"]
+                        newer["base_revision"] = pending["base_revision"]
+                    # Пока Drive недоступен, повторы идут все реже
+                    newer["failures"] = pending["failures"] + 1
+                    newer["retry_at"] = time.time() + min(JSON_FLUSH_DEBOUNCE * 2 ** min(newer["failures"], 16),
+                                                          JSON_FLUSH_MAX_BACKOFF)
+                    json_flush_condition.notify()
+
+def json_flusher():
+    """Фоновый поток отложенной записи JSON файлов"""
+    while True:
+        with json_flush_condition:
+            while not pending_json_writes:
+                json_flush_condition.wait()
+            
+            delay = min(get_json_write_due_at(pending) for pending in pending_json_writes.values()) - time.time()
+            if delay > 0:
+                json_flush_condition.wait(delay)
+                continue
+        
+        flush_json_files(force=False)
+
+def start_json_flusher():
+    """Запускает поток отложенной записи (один раз на процесс)"""
+    global json_flusher_started
+    with json_flush_condition:
+        if json_flusher_started:
+            return
+        json_flusher_started = True
+    threading.Thread(target=json_flusher, daemon=True).start()
+
+def get_json_flush_stats():
+    """Возвращает счетчики отложенной записи: загрузки, задержки, объем в очереди"""
+    with json_flush_condition:
+        stats = dict(json_flush_stats)
+        stats["pending_files"] = len(pending_json_writes)
+        stats["pending_bytes"] = sum(len(pending["content"]) for pending in pending_json_writes.values())
+    return stats
+
+atexit.register(flush_json_files)
+
+# ========== ЛЕНТА ИЗМЕНЕНИЙ GOOGLE DRIVE ==========
+# Пока лента опрашивается успешно, кэш считается актуальным без проверки по TTL:
+# обновляются только файлы, о которых сообщил changes().list
+drive_changes_state = {"page_token": None, "last_success": 0}
+screenshots_changed = threading.Event()
+drive_changes_started = False
+
+def load_changes_page_token():
+    """Загружает сохраненный startPageToken ленты изменений"""
+    if not os.path.exists(DRIVE_CHANGES_FILE):
+        return None
+    try:
+        with open(DRIVE_CHANGES_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f).get("page_token")
+    except Exception as e:
+        print(f"⚠️ Ошибка загрузки токена ленты изменений: {e}")
+        return None
+
+def save_changes_page_token(page_token):
+    """Сохраняет startPageToken ленты изменений на диск"""
+    drive_changes_state["page_token"] = page_token
+    try:
+        with open(DRIVE_CHANGES_FILE, 'w', encoding='utf-8') as f:
+            json.dump({"page_token": page_token, "saved_at": datetime.now().isoformat()}, f)
+    except Exception as e:
+        print(f"⚠️ Ошибка сохранения токена ленты изменений: {e}")
+
+def is_drive_changes_active():
+    """Проверяет, что лента изменений недавно опрашивалась без ошибок"""
+    return time.time() - drive_changes_state["last_success"] < DRIVE_CHANGES_INTERVAL * 3
 
-def save_delayed_tasks(tasks):
-    """Сохраняет отложенные задачи"""
-    return save_json_file(DELAYED_TASKS_FILE, tasks)
+def find_indexed_file(file_id):
+    """Ищет файл в индексе по id, возвращает (folder_id, file_name)"""
+    with drive_index_lock:
+        for folder_id, files in drive_file_index.items():
+            for file_name, indexed_id in files.items():
+                if indexed_id == file_id:
+                    return folder_id, file_name
+    return None, None
+
+def apply_drive_change(change):
+    """Применяет одно изменение из ленты к индексу и кэшам"""
+    file_id = change.get('fileId')
+    file = change.get('file') or {}
+    removed = change.get('removed') or file.get('trashed')
+    
+    folder_id = next((folder for folder in (GOOGLE_DRIVE_FOLDER_ID, SCREENSHOTS_FOLDER_ID)
+                      if folder and folder in file.get('parents', [])), None)
+    file_name = file.get('name')
+    if not folder_id or not file_name:
+        folder_id, file_name = find_indexed_file(file_id)
+    if not folder_id:
+        return
+    
+    if removed:
+        if find_indexed_file(file_id)[0]:
+            forget_drive_file(folder_id, file_name)
+    else:
+        remember_drive_files(folder_id, [{'id': file_id, 'name': file_name}])
+    
+    if folder_id == GOOGLE_DRIVE_FOLDER_ID:
+        invalidate_json_cache(file_name, None if removed else file)
+    elif folder_id == SCREENSHOTS_FOLDER_ID:
+        cached = screenshot_meta_cache.get(file_id)
+        if removed or not cached or cached[0] != file.get('md5Checksum'):
+            screenshots_changed.set()
+
+def reset_changes_page_token(service):
+    """Берет новый startPageToken и сбрасывает кэши, так как изменения до него могли потеряться"""
+    save_changes_page_token(service.changes().getStartPageToken().execute().get('startPageToken'))
+    with json_cache_lock:
+        for filename in [name for name, entry in json_cache.items() if not entry["dirty"]]:
+            del json_cache[filename]
+    # Роли и индексы журналов при активной ленте тоже считаются актуальными без проверки по TTL
+    invalidate_auth_roles()
+    with journal_lock:
+        journal_indexes.clear()
+
+def poll_drive_changes(service):
+    """Забирает накопившиеся изменения из ленты, возвращает их количество"""
+    page_token = drive_changes_state["page_token"]
+    count = 0
+    if not page_token:
+        # Без токена лента не работает: кэш остается на проверке по TTL
+        return count
+    
+    while page_token:
+        results = service.changes().list(
+            pageToken=page_token, spaces='drive', pageSize=1000,
+            fields='nextPageToken, newStartPageToken, '
+                   'changes(fileId, removed, file(name, parents, trashed, headRevisionId, md5Checksum))'
+        ).execute()
+        
+        for change in results.get('changes', []):
+            apply_drive_change(change)
+            count += 1
+        
+        if results.get('newStartPageToken'):
+            save_changes_page_token(results['newStartPageToken'])
+            break
+        page_token = results.get('nextPageToken')
+    
+    drive_changes_state["last_success"] = time.time()
+    return count
+
+def drive_changes_watcher():
+    """Фоново опрашивает ленту изменений Google Drive"""
+    while True:
+        time.sleep(DRIVE_CHANGES_INTERVAL)
+        try:
+            service = get_drive_service()
+            if service and not drive_changes_state["page_token"]:
+                # Токен не удалось получить при запуске или он устарел
+                reset_changes_page_token(service)
+            elif service:
+                poll_drive_changes(service)
+        except HttpError as e:
+            print(f"⚠️ Ошибка ленты изменений: {e}")
+            if e.resp.status in (400, 404):
+                # Токен устарел: новый будет взят на следующей итерации
+                drive_changes_state["page_token"] = None
+        except Exception as e:
+            print(f"⚠️ Ошибка ленты изменений: {e}")
+
+def start_drive_changes_watcher(service):
+    """Запускает опрос ленты изменений (один раз на процесс)"""
+    global drive_changes_started
+    if drive_changes_started:
+        return
+    
+    page_token = load_changes_page_token()
+    try:
+        if page_token:
+            drive_changes_state["page_token"] = page_token
+            print(f"🔄 Изменений в Google Drive с прошлого запуска: {poll_drive_changes(service)}")
+        else:
+            response = service.changes().getStartPageToken().execute()
+            save_changes_page_token(response.get('startPageToken'))
+            drive_changes_state["last_success"] = time.time()
+    except Exception as e:
+        print(f"⚠️ Лента изменений недоступна, используется проверка по TTL: {e}")
+        try:
+            response = service.changes().getStartPageToken().execute()
+            save_changes_page_token(response.get('startPageToken'))
+        except Exception as e:
+            # Токен запросит фоновый поток, до этого кэш проверяется по TTL
+            print(f"⚠️ Ошибка получения токена ленты изменений: {e}")
+            drive_changes_state["page_token"] = None
+    
+    drive_changes_started = True
+    screenshots_changed.set()
+    threading.Thread(target=drive_changes_watcher, daemon=True).start()
+
+# ========== ЖУРНАЛ ОТЛОЖЕННЫХ ЗАДАЧ, КОМАНД ПК И ОЧЕРЕДИ EMAIL ==========
+# Добавление или изменение задачи/команды/рассылки - одна строка в локальном журнале (JSONL);
+# текущее состояние = снимок в Drive + хвост журнала. Компактизация переносит журнал в снимок
+JOURNAL_COLLECTIONS = {DELAYED_TASKS_FILE: "tasks", PC_COMMANDS_FILE: "commands", EMAIL_OUTBOX_FILE: "broadcasts"}
+journal_events = {}  # filename -> [event, ...] (еще не перенесенные в снимок)
+journal_lock = threading.RLock()
+journal_compact_requested = threading.Event()
+journal_indexes = {}  # filename -> {"items": {id: запись}, "built_at": ...} - текущее состояние по id
+journal_generations = {}  # filename -> сколько раз журнал переносился в снимок
+journal_compaction_locks = {filename: threading.Lock() for filename in JOURNAL_COLLECTIONS}
+journal_compactor_started = False
+
+def get_journal_path(filename):
+    """Возвращает путь к локальному журналу файла"""
+    return os.path.join(JOURNAL_DIR, os.path.splitext(filename)[0] + ".jsonl")
+
+def get_journal_events(filename):
+    """Возвращает хвост журнала (при первом обращении читает его с диска)"""
+    with journal_lock:
+        if filename not in journal_events:
+            events = []
+            try:
+                with open(get_journal_path(filename), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            events.append(json.loads(line))
+                        except ValueError:
+                            # Недописанная при сбое строка
+                            print(f"⚠️ Пропущена поврежденная запись журнала {filename}")
+            except FileNotFoundError:
+                pass
+            journal_events[filename] = events
+        return journal_events[filename]
+
+def append_journal_event(filename, event, urgent=False):
+    """Дописывает событие в журнал; urgent - перенести в снимок Drive без ожидания"""
+    try:
+        with journal_lock:
+            events = get_journal_events(filename)
+            os.makedirs(JOURNAL_DIR, exist_ok=True)
+            with open(get_journal_path(filename), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            events.append(copy.deepcopy(event))
+            pending_count = len(events)
+            if filename in journal_indexes:
+                apply_journal_event(journal_indexes[filename]["items"], event)
+    except Exception as e:
+        print(f"❌ Ошибка записи в журнал {filename}: {e}")
+        return False
+    
+    if urgent or pending_count >= JOURNAL_COMPACT_EVENTS:
+        journal_compact_requested.set()
+    start_journal_compactor()
+    return True
+
+def apply_journal_event(items, event):
+    """Применяет событие журнала к записям, индексированным по id; повторное применение ничего не меняет"""
+    if event["op"] == "add":
+        items.setdefault(event["item"].get("id"), copy.deepcopy(event["item"]))
+    elif event["op"] == "update":
+        if event["id"] in items:
+            items[event["id"]].update(copy.deepcopy(event["changes"]))
+    elif event["op"] == "update_many":
+        for item_id, changes in event["changes"].items():
+            if item_id in items:
+                items[item_id].update(copy.deepcopy(changes))
+    elif event["op"] == "update_field":
+        if event["id"] in items:
+            items[event["id"]].setdefault(event["field"], {}).update(copy.deepcopy(event["changes"]))
+    elif event["op"] == "remove":
+        for item_id in event["ids"]:
+            items.pop(item_id, None)
+
+def apply_journal_events(data, key, events):
+    """Применяет события журнала к снимку"""
+    items = {item.get("id"): item for item in data[key]}
+    for event in events:
+        apply_journal_event(items, event)
+    data[key] = list(items.values())
+    return bool(events)
+
+def get_journaled_index(filename):
+    """Возвращает живой индекс записей файла по id (снимок + хвост журнала); читать под journal_lock"""
+    with journal_lock:
+        index = journal_indexes.get(filename)
+        if index and (is_drive_changes_active() or time.time() - index["built_at"] < JSON_CACHE_TTL):
+            return index["items"]
+    
+    key = JOURNAL_COLLECTIONS[filename]
+    while True:
+        with journal_lock:
+            generation = journal_generations.get(filename, 0)
+        
+        data = normalize_json_data(load_json_file(filename, {key: []}), {key: []})
+        
+        with journal_lock:
+            # Если журнал успели перенести в снимок, загруженная версия снимка устарела
+            if journal_generations.get(filename, 0) != generation:
+                continue
+            
+            items = {item.get("id"): item for item in data[key]}
+            for event in get_journal_events(filename):
+                apply_journal_event(items, event)
+            journal_indexes[filename] = {"items": items, "built_at": time.time()}
+            return items
+
+def invalidate_journaled_index(filename):
+    """Сбрасывает индекс записей файла (файл изменен извне)"""
+    with journal_lock:
+        journal_indexes.pop(filename, None)
+
+def read_journaled_items(filename):
+    """Возвращает текущий список записей: снимок из Drive плюс хвост журнала"""
+    items = get_journaled_index(filename)
+    with journal_lock:
+        return copy.deepcopy(list(items.values()))
+
+def get_journaled_item(filename, item_id):
+    """Возвращает запись по id или None"""
+    items = get_journaled_index(filename)
+    with journal_lock:
+        return copy.deepcopy(items.get(item_id))
+
+def compact_journal(filename):
+    """Переносит журнал в снимок Drive и возвращает количество перенесенных событий"""
+    # Поток компактизации и flush при выходе не должны переносить и обрезать журнал одновременно:
+    # вторая обрезка по длине списка потеряла бы события, добавленные после первой
+    with journal_compaction_locks[filename]:
+        with journal_lock:
+            events = list(get_journal_events(filename))
+        
+        if not events:
+            return 0
+        
+        key = JOURNAL_COLLECTIONS[filename]
+        # Если снимок не удалось прочитать, журнал остается до следующей попытки
+        if not update_json_file(filename, {key: []}, lambda data: apply_journal_events(data, key, events)):
+            return 0
+        flush_json_files()
+        
+        # Журнал укорачивается только после того, как снимок действительно загружен
+        with json_cache_lock:
+            entry = json_cache.get(filename)
+            if not entry or entry["dirty"]:
+                return 0
+        
+        with journal_lock:
+            remaining = journal_events[filename][len(events):]
+            path = get_journal_path(filename)
+            temp_path = path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for event in remaining:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+            journal_events[filename] = remaining
+            journal_generations[filename] = journal_generations.get(filename, 0) + 1
+        
+        return len(events)
+
+def compact_all_journals():
+    """Компактизирует журналы всех файлов"""
+    for filename in JOURNAL_COLLECTIONS:
+        try:
+            compact_journal(filename)
+        except Exception as e:
+            print(f"❌ Ошибка компактизации журнала {filename}: {e}")
+
+def journal_compactor():
+    """Фоновый поток: компактизация по запросу или раз в JOURNAL_COMPACT_INTERVAL секунд"""
+    while True:
+        journal_compact_requested.wait(JOURNAL_COMPACT_INTERVAL)
+        journal_compact_requested.clear()
+        compact_all_journals()
+
+def start_journal_compactor():
+    """Запускает поток компактизации журналов, если он еще не запущен"""
+    global journal_compactor_started
+    
+    with journal_lock:
+        if journal_compactor_started:
+            return
+        journal_compactor_started = True
+    
+    threading.Thread(target=journal_compactor, daemon=True).start()
+
+# ========== ХРАНИЛИЩЕ СОСТОЯНИЯ ==========
+class DriveStateBackend:
+    """Состояние бота в JSON файлах Google Drive; задачи, команды ПК и очередь email - через журнал"""
+    
+    def start(self):
+        """Запускает фоновые процессы хранилища"""
+        start_journal_compactor()
+        if any(get_journal_events(filename) for filename in JOURNAL_COLLECTIONS):
+            journal_compact_requested.set()
+    
+    def flush(self):
+        """Сохраняет отложенные изменения"""
+        compact_all_journals()
+    
+    # --- email ---
+    def get_emails(self, user_id=None):
+        """Возвращает записи email (все или одного пользователя)"""
+        emails_data = load_json_file(EMAILS_FILE, {"emails": []})
+        
+        if not isinstance(emails_data, dict) or "emails" not in emails_data:
+            return []
+        
+        if user_id is None:
+            return emails_data["emails"]
+        return [item for item in emails_data["emails"] if item["user_id"] == user_id]
+    
+    def add_email(self, user_id, email, added_date):
+        """Добавляет email; False, если такая запись уже есть"""
+        def add(emails_data):
+            for item in emails_data["emails"]:
+                if item["user_id"] == user_id and item["email"] == email:
+                    return False
+            
+            emails_data["emails"].append({
+                "user_id": user_id,
+                "email": email,
+                "added_date": added_date
+            })
+            return True
+        
+        return update_json_file(EMAILS_FILE, {"emails": []}, add)
+    
+    def delete_email(self, email):
+        """Удаляет email у всех пользователей"""
+        def delete(emails_data):
+            original_count = len(emails_data["emails"])
+            emails_data["emails"][:] = [item for item in emails_data["emails"] if item["email"] != email]
+            return len(emails_data["emails"]) < original_count
+        
+        return update_json_file(EMAILS_FILE, {"emails": []}, delete)
+    
+    # --- авторизованные пользователи ---
+    def get_auth_users(self, user_type=None):
+        """Возвращает авторизованных пользователей (всех или одной роли)"""
+        auth_data = load_json_file(AUTH_USERS_FILE, {"users": []})
+        
+        if not isinstance(auth_data, dict) or "users" not in auth_data:
+            return []
+        
+        if user_type is None:
+            return auth_data["users"]
+        return [user for user in auth_data["users"] if user["user_type"] == user_type]
+    
+    def get_user_type(self, user_id):
+        """Возвращает роль пользователя или None"""
+        for user in self.get_auth_users():
+            if user["user_id"] == user_id:
+                return user["user_type"]
+        return None
+    
+    def add_auth_user(self, user_type, user_id, added_date):
+        """Добавляет пользователя с ролью; False, если он уже есть"""
+        def add(auth_data):
+            for user in auth_data["users"]:
+                if user["user_id"] == user_id and user["user_type"] == user_type:
+                    return False
+            
+            auth_data["users"].append({
+                "user_id": user_id,
+                "user_type": user_type,
+                "added_date": added_date
+            })
+            return True
+        
+        return update_json_file(AUTH_USERS_FILE, {"users": []}, add)
+    
+    # --- настройки ---
+    def get_setting(self, key, default=None):
+        """Возвращает значение настройки"""
+        settings_data = load_json_file(SETTINGS_FILE, {"settings": {}})
+        
+        if not isinstance(settings_data, dict) or "settings" not in settings_data:
+            return default
+        
+        return settings_data["settings"].get(key, default)
+    
+    def set_setting(self, key, value):
+        """Сохраняет значение настройки"""
+        def set_value(settings_data):
+            settings_data["settings"][key] = value
+            return True
+        
+        return update_json_file(SETTINGS_FILE, {"settings": {}}, set_value)
+    
+    # --- токены MAX_APP ---
+    def get_tokens(self):
+        """Возвращает сохраненные токены (token -> данные)"""
+        return load_json_file(PLATON_TOKENS_FILE, {"tokens": {}}).get("tokens", {})
+    
+    def save_token(self, token, token_data):
+        """Сохраняет токен"""
+        def save(tokens_data):
+            tokens_data["tokens"][token] = copy.deepcopy(token_data)
+            return True
+        
+        return update_json_file(PLATON_TOKENS_FILE, {"tokens": {}}, save)
+    
+    def revoke_tokens(self, revoked_at):
+        """Удаляет все токены"""
+        def revoke(tokens_data):
+            tokens_data["tokens"].clear()
+            tokens_data["revoked_at"] = revoked_at
+            return True
+        
+        return update_json_file(PLATON_TOKENS_FILE, {"tokens": {}}, revoke)
+    
+    def delete_tokens(self, tokens):
+        """Удаляет перечисленные токены одной записью"""
+        def delete(tokens_data):
+            return bool([token for token in tokens if tokens_data["tokens"].pop(token, None) is not None])
+        
+        return update_json_file(PLATON_TOKENS_FILE, {"tokens": {}}, delete)
+    
+    # --- отложенные задачи ---
+    def get_delayed_tasks(self):
+        """Возвращает все отложенные задачи"""
+        return read_journaled_items(DELAYED_TASKS_FILE)
+    
+    def get_delayed_task(self, task_id):
+        """Возвращает задачу по id или None"""
+        return get_journaled_item(DELAYED_TASKS_FILE, task_id)
+    
+    def add_delayed_task(self, task):
+        """Добавляет задачу"""
+        return append_journal_event(DELAYED_TASKS_FILE, {"op": "add", "item": task})
+    
+    def update_delayed_task(self, task_id, changes):
+        """Обновляет поля задачи"""
+        return append_journal_event(DELAYED_TASKS_FILE, {"op": "update", "id": task_id, "changes": changes})
+    
+    def update_delayed_tasks(self, changes_by_id):
+        """Обновляет поля нескольких задач одной записью журнала"""
+        return append_journal_event(DELAYED_TASKS_FILE, {"op": "update_many", "changes": changes_by_id})
+    
+    def remove_delayed_tasks(self, task_ids):
+        """Удаляет задачи по id"""
+        return append_journal_event(DELAYED_TASKS_FILE, {"op": "remove", "ids": sorted(task_ids)})
+    
+    # --- команды ПК ---
+    def get_pc_commands(self):
+        """Возвращает все команды ПК"""
+        return read_journaled_items(PC_COMMANDS_FILE)
+    
+    def add_pc_command(self, command):
+        """Добавляет команду ПК"""
+        # Агент на ПК читает только снимок pc_commands.json, поэтому команда переносится в него сразу
+        return append_journal_event(PC_COMMANDS_FILE, {"op": "add", "item": command}, urgent=True)
+    
+    def remove_pc_commands(self, command_ids):
+        """Удаляет команды ПК по id"""
+        return append_journal_event(PC_COMMANDS_FILE, {"op": "remove", "ids": sorted(command_ids)})
+    
+    # --- очередь email ---
+    def get_email_broadcasts(self):
+        """Возвращает все рассылки очереди"""
+        return read_journaled_items(EMAIL_OUTBOX_FILE)
+    
+    def get_email_broadcast(self, broadcast_id):
+        """Возвращает рассылку по id или None"""
+        return get_journaled_item(EMAIL_OUTBOX_FILE, broadcast_id)
+    
+    def add_email_broadcast(self, broadcast):
+        """Добавляет рассылку (рассылка с тем же id не перезаписывается)"""
+        return append_journal_event(EMAIL_OUTBOX_FILE, {"op": "add", "item": broadcast})
+    
+    def update_email_broadcast(self, broadcast_id, changes):
+        """Обновляет поля рассылки"""
+        return append_journal_event(EMAIL_OUTBOX_FILE, {"op": "update", "id": broadcast_id, "changes": changes})
+    
+    def update_email_recipients(self, broadcast_id, states):
+        """Сохраняет состояние доставки получателям: {email: состояние}"""
+        return append_journal_event(EMAIL_OUTBOX_FILE, {"op": "update_field", "id": broadcast_id,
+                                                        "field": "recipients", "changes": states})
+    
+    def remove_email_broadcasts(self, broadcast_ids):
+        """Удаляет рассылки по id"""
+        return append_journal_event(EMAIL_OUTBOX_FILE, {"op": "remove", "ids": sorted(broadcast_ids)})
+
+class SQLiteStateBackend:
+    """Состояние бота в локальной SQLite (WAL); Google Drive - фоновые снимки в прежнем JSON формате"""
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS emails (
+            user_id INTEGER NOT NULL,
+            email TEXT NOT NULL,
+            added_date TEXT,
+            PRIMARY KEY (user_id, email)
+        );
+        CREATE INDEX IF NOT EXISTS idx_emails_email ON emails (email);
+        
+        CREATE TABLE IF NOT EXISTS auth_users (
+            user_id INTEGER NOT NULL,
+            user_type TEXT NOT NULL,
+            added_date TEXT,
+            PRIMARY KEY (user_id, user_type)
+        );
+        CREATE INDEX IF NOT EXISTS idx_auth_users_type ON auth_users (user_type);
+        
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        
+        CREATE TABLE IF NOT EXISTS delayed_tasks (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            scheduled_time TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_delayed_tasks_status ON delayed_tasks (status, scheduled_time);
+        
+        CREATE TABLE IF NOT EXISTS email_broadcasts (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        
+        CREATE TABLE IF NOT EXISTS email_recipients (
+            broadcast_id TEXT NOT NULL,
+            email TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (broadcast_id, email)
+        );
+        
+        CREATE TABLE IF NOT EXISTS state_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+    
+    def __init__(self, db_file):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.drive = DriveStateBackend()
+        
+        self.dirty_files = set()
+        self.dirty_lock = threading.Lock()
+        self.snapshot_event = threading.Event()
+        self.exporters = {
+            EMAILS_FILE: lambda: {"emails": self.get_emails()},
+            AUTH_USERS_FILE: lambda: {"users": self.get_auth_users()},
+            SETTINGS_FILE: lambda: {"settings": self.get_settings()},
+            DELAYED_TASKS_FILE: lambda: {"tasks": self.get_delayed_tasks()},
+            EMAIL_OUTBOX_FILE: lambda: {"broadcasts": self.get_email_broadcasts()},
+        }
+    
+    def start(self):
+        """Восстанавливает состояние из Drive (для новой базы) и запускает фоновые снимки"""
+        if not self.get_meta("restored_at"):
+            self.restore_from_drive()
+        self.drive.start()
+        threading.Thread(target=self.snapshot_loop, daemon=True).start()
+    
+    # --- служебное ---
+    def query(self, sql, params=()):
+        """Выполняет SELECT и возвращает все строки"""
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+    
+    def execute(self, sql, params=()):
+        """Выполняет изменяющий запрос в отдельной транзакции и возвращает число строк"""
+        with self.lock, self.conn:
+            return self.conn.execute(sql, params).rowcount
+    
+    def get_meta(self, key):
+        """Читает служебное значение"""
+        rows = self.query("SELECT value FROM state_meta WHERE key = ?", (key,))
+        return rows[0]["value"] if rows else None
+    
+    def set_meta(self, key, value):
+        """Записывает служебное значение"""
+        self.execute(
+            "INSERT INTO state_meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+    
+    # --- снимки в Google Drive ---
+    def mark_dirty(self, filename, urgent=False):
+        """Отмечает файл для выгрузки в Drive при следующем снимке"""
+        with self.dirty_lock:
+            self.dirty_files.add(filename)
+        if urgent:
+            self.snapshot_event.set()
+    
+    def flush(self):
+        """Выгружает в Drive все измененные файлы"""
+        with self.dirty_lock:
+            filenames = list(self.dirty_files)
+            self.dirty_files.clear()
+        
+        for filename in filenames:
+            try:
+                if save_json_file(filename, self.exporters[filename]()):
+                    continue
+            except Exception as e:
+                print(f"⚠️ Ошибка снимка {filename}: {e}")
+            with self.dirty_lock:
+                self.dirty_files.add(filename)
+        
+        self.drive.flush()
+    
+    def snapshot_loop(self):
+        """Периодически выгружает изменения в Drive"""
+        while True:
+            self.snapshot_event.wait(STATE_SNAPSHOT_INTERVAL)
+            self.snapshot_event.clear()
+            self.flush()
+    
+    def restore_from_drive(self):
+        """Заполняет пустую базу из JSON файлов Google Drive"""
+        print("🔄 Восстанавливаю состояние из Google Drive...")
+        
+        sources = {
+            EMAILS_FILE: {"emails": []},
+            AUTH_USERS_FILE: {"users": []},
+            SETTINGS_FILE: {"settings": {}},
+            DELAYED_TASKS_FILE: {"tasks": []},
+            EMAIL_OUTBOX_FILE: {"broadcasts": []}
+        }
+        loaded = {filename: load_json_file(filename, default_data, strict=True)
+                  for filename, default_data in sources.items()}
+        failed = [filename for filename, data in loaded.items() if data is None]
+        if failed:
+            # База без этих данных выгрузила бы в Drive только новые записи и затерла бы файлы
+            raise RuntimeError(f"не удалось загрузить {', '.join(failed)}")
+        
+        emails_data = loaded[EMAILS_FILE]
+        auth_data = loaded[AUTH_USERS_FILE]
+        settings_data = loaded[SETTINGS_FILE]
+        # Индекс мог быть построен раньше по неудачной загрузке снимка
+        invalidate_journaled_index(DELAYED_TASKS_FILE)
+        invalidate_journaled_index(EMAIL_OUTBOX_FILE)
+        tasks_data = {"tasks": read_journaled_items(DELAYED_TASKS_FILE)}
+        broadcasts = read_journaled_items(EMAIL_OUTBOX_FILE)
+        
+        with self.lock, self.conn:
+            for item in emails_data.get("emails", []) if isinstance(emails_data, dict) else []:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO emails (user_id, email, added_date) VALUES (?, ?, ?)",
+                    (item["user_id"], item["email"], item.get("added_date"))
+                )
+            for user in auth_data.get("users", []) if isinstance(auth_data, dict) else []:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO auth_users (user_id, user_type, added_date) VALUES (?, ?, ?)",
+                    (user["user_id"], user["user_type"], user.get("added_date"))
+                )
+            for key, value in (settings_data.get("settings", {}) if isinstance(settings_data, dict) else {}).items():
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False))
+                )
+            for task in tasks_data.get("tasks", []):
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO delayed_tasks (id, status, scheduled_time, data) VALUES (?, ?, ?, ?)",
+                    (task["id"], task["status"], task.get("scheduled_time"), json.dumps(task, ensure_ascii=False))
+                )
+            for broadcast in broadcasts:
+                self.insert_email_broadcast(broadcast)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO state_meta (key, value) VALUES ('restored_at', ?)",
+                (datetime.now().isoformat(),)
+            )
+        
+        print("✅ Состояние восстановлено из Google Drive")
+    
+    # --- email ---
+    def get_emails(self, user_id=None):
+        """Возвращает записи email (все или одного пользователя)"""
+        if user_id is None:
+            rows = self.query("SELECT user_id, email, added_date FROM emails ORDER BY rowid")
+        else:
+            rows = self.query("SELECT user_id, email, added_date FROM emails WHERE user_id = ? ORDER BY rowid",
+                              (user_id,))
+        return [dict(row) for row in rows]
+    
+    def add_email(self, user_id, email, added_date):
+        """Добавляет email; False, если такая запись уже есть"""
+        added = self.execute(
+            "INSERT OR IGNORE INTO emails (user_id, email, added_date) VALUES (?, ?, ?)",
+            (user_id, email, added_date)
+        )
+        if added:
+            self.mark_dirty(EMAILS_FILE)
+        return bool(added)
+    
+    def delete_email(self, email):
+        """Удаляет email у всех пользователей"""
+        deleted = self.execute("DELETE FROM emails WHERE email = ?", (email,))
+        if deleted:
+            self.mark_dirty(EMAILS_FILE)
+        return bool(deleted)
+    
+    # --- авторизованные пользователи ---
+    def get_auth_users(self, user_type=None):
+        """Возвращает авторизованных пользователей (всех или одной роли)"""
+        if user_type is None:
+            rows = self.query("SELECT user_id, user_type, added_date FROM auth_users ORDER BY rowid")
+        else:
+            rows = self.query("SELECT user_id, user_type, added_date FROM auth_users WHERE user_type = ? ORDER BY rowid",
+                              (user_type,))
+        return [dict(row) for row in rows]
+    
+    def get_user_type(self, user_id):
+        """Возвращает роль пользователя или None"""
+        rows = self.query("SELECT user_type FROM auth_users WHERE user_id = ? ORDER BY rowid LIMIT 1", (user_id,))
+        return rows[0]["user_type"] if rows else None
+    
+    def add_auth_user(self, user_type, user_id, added_date):
+        """Добавляет пользователя с ролью; False, если он уже есть"""
+        added = self.execute(
+            "INSERT OR IGNORE INTO auth_users (user_id, user_type, added_date) VALUES (?, ?, ?)",
+            (user_id, user_type, added_date)
+        )
+        if added:
+            self.mark_dirty(AUTH_USERS_FILE)
+        return bool(added)
+    
+    # --- настройки ---
+    def get_settings(self):
+        """Возвращает все настройки"""
+        return {row["key"]: json.loads(row["value"]) for row in self.query("SELECT key, value FROM settings")}
+    
+    def get_setting(self, key, default=None):
+        """Возвращает значение настройки"""
+        rows = self.query("SELECT value FROM settings WHERE key = ?", (key,))
+        return json.loads(rows[0]["value"]) if rows else default
+    
+    def set_setting(self, key, value):
+        """Сохраняет значение настройки"""
+        self.execute(
+            "INSERT INTO settings (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value, ensure_ascii=False))
+        )
+        self.mark_dirty(SETTINGS_FILE)
+        return True
+    
+    # --- токены MAX_APP ---
+    # platon_tokens.json и pc_commands.json меняют и внешние программы (веб-приложение MAX_APP
+    # отмечает использованные токены, агент на ПК - выполненные команды), поэтому эти файлы
+    # остаются в Drive, как в DriveStateBackend: выгрузка локальной копии затерла бы их изменения
+    def get_tokens(self):
+        """Возвращает сохраненные токены (token -> данные)"""
+        return self.drive.get_tokens()
+    
+    def save_token(self, token, token_data):
+        """Сохраняет токен"""
+        return self.drive.save_token(token, token_data)
+    
+    def revoke_tokens(self, revoked_at):
+        """Удаляет все токены"""
+        return self.drive.revoke_tokens(revoked_at)
+    
+    def delete_tokens(self, tokens):
+        """Удаляет перечисленные токены одной записью"""
+        return self.drive.delete_tokens(tokens)
+
+    # --- отложенные задачи ---
+    def get_delayed_tasks(self):
+        """Возвращает все отложенные задачи"""
+        return [json.loads(row["data"]) for row in self.query("SELECT data FROM delayed_tasks ORDER BY rowid")]
+    
+    def get_delayed_task(self, task_id):
+        """Возвращает задачу по id или None"""
+        rows = self.query("SELECT data FROM delayed_tasks WHERE id = ?", (task_id,))
+        return json.loads(rows[0]["data"]) if rows else None
+    
+    def add_delayed_task(self, task):
+        """Добавляет задачу"""
+        self.execute(
+            "INSERT OR REPLACE INTO delayed_tasks (id, status, scheduled_time, data) VALUES (?, ?, ?, ?)",
+            (task["id"], task["status"], task.get("scheduled_time"), json.dumps(task, ensure_ascii=False))
+        )
+        self.mark_dirty(DELAYED_TASKS_FILE)
+        return True
+    
+    def update_delayed_task(self, task_id, changes):
+        """Обновляет поля задачи"""
+        return self.update_delayed_tasks({task_id: changes})
+    
+    def update_delayed_tasks(self, changes_by_id):
+        """Обновляет поля нескольких задач одной транзакцией"""
+        with self.lock, self.conn:
+            for task_id, changes in changes_by_id.items():
+                row = self.conn.execute("SELECT data FROM delayed_tasks WHERE id = ?", (task_id,)).fetchone()
+                if not row:
+                    continue
+                task = json.loads(row["data"])
+                task.update(changes)
+                self.conn.execute(
+                    "UPDATE delayed_tasks SET status = ?, scheduled_time = ?, data = ? WHERE id = ?",
+                    (task["status"], task.get("scheduled_time"), json.dumps(task, ensure_ascii=False), task_id)
+                )
+        self.mark_dirty(DELAYED_TASKS_FILE)
+        return True
+    
+    def remove_delayed_tasks(self, task_ids):
+        """Удаляет задачи по id"""
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM delayed_tasks WHERE id = ?", [(task_id,) for task_id in task_ids])
+        self.mark_dirty(DELAYED_TASKS_FILE)
+        return True
+    
+    # --- команды ПК (в Drive, см. токены MAX_APP) ---
+    def get_pc_commands(self):
+        """Возвращает все команды ПК"""
+        return self.drive.get_pc_commands()
+    
+    def add_pc_command(self, command):
+        """Добавляет команду ПК"""
+        return self.drive.add_pc_command(command)
+    
+    def remove_pc_commands(self, command_ids):
+        """Удаляет команды ПК по id"""
+        return self.drive.remove_pc_commands(command_ids)
+
+    # --- очередь email ---
+    def row_to_email_broadcast(self, row):
+        """Собирает рассылку вместе с состоянием доставки получателям"""
+        broadcast = json.loads(row["data"])
+        broadcast["recipients"] = {
+            recipient["email"]: json.loads(recipient["data"])
+            for recipient in self.query("SELECT email, data FROM email_recipients WHERE broadcast_id = ? ORDER BY rowid",
+                                        (row["id"],))
+        }
+        return broadcast
+    
+    def get_email_broadcasts(self):
+        """Возвращает все рассылки очереди"""
+        return [self.row_to_email_broadcast(row) for row in self.query("SELECT id, data FROM email_broadcasts ORDER BY rowid")]
+    
+    def get_email_broadcast(self, broadcast_id):
+        """Возвращает рассылку по id или None"""
+        rows = self.query("SELECT id, data FROM email_broadcasts WHERE id = ?", (broadcast_id,))
+        return self.row_to_email_broadcast(rows[0]) if rows else None
+    
+    def insert_email_broadcast(self, broadcast):
+        """Вставляет рассылку и ее получателей (вызывать внутри транзакции)"""
+        data = {key: value for key, value in broadcast.items() if key != "recipients"}
+        inserted = self.conn.execute(
+            "INSERT OR IGNORE INTO email_broadcasts (id, status, data) VALUES (?, ?, ?)",
+            (broadcast["id"], broadcast["status"], json.dumps(data, ensure_ascii=False))
+        ).rowcount
+        if inserted:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO email_recipients (broadcast_id, email, data) VALUES (?, ?, ?)",
+                [(broadcast["id"], email, json.dumps(state, ensure_ascii=False))
+                 for email, state in broadcast.get("recipients", {}).items()]
+            )
+    
+    def add_email_broadcast(self, broadcast):
+        """Добавляет рассылку (рассылка с тем же id не перезаписывается)"""
+        with self.lock, self.conn:
+            self.insert_email_broadcast(broadcast)
+        self.mark_dirty(EMAIL_OUTBOX_FILE)
+        return True
+    
+    def update_email_broadcast(self, broadcast_id, changes):
+        """Обновляет поля рассылки"""
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT data FROM email_broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+            if not row:
+                return False
+            data = json.loads(row["data"])
+            data.update(changes)
+            self.conn.execute(
+                "UPDATE email_broadcasts SET status = ?, data = ? WHERE id = ?",
+                (data["status"], json.dumps(data, ensure_ascii=False), broadcast_id)
+            )
+        self.mark_dirty(EMAIL_OUTBOX_FILE)
+        return True
+    
+    def update_email_recipients(self, broadcast_id, states):
+        """Сохраняет состояние доставки получателям: {email: состояние}"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO email_recipients (broadcast_id, email, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(broadcast_id, email) DO UPDATE SET data = excluded.data",
+                [(broadcast_id, email, json.dumps(state, ensure_ascii=False)) for email, state in states.items()]
+            )
+        self.mark_dirty(EMAIL_OUTBOX_FILE)
+        return True
+    
+    def remove_email_broadcasts(self, broadcast_ids):
+        """Удаляет рассылки по id"""
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM email_recipients WHERE broadcast_id = ?",
+                                  [(broadcast_id,) for broadcast_id in broadcast_ids])
+            self.conn.executemany("DELETE FROM email_broadcasts WHERE id = ?",
+                                  [(broadcast_id,) for broadcast_id in broadcast_ids])
+        self.mark_dirty(EMAIL_OUTBOX_FILE)
+        return True
+
+state_backend = DriveStateBackend()
+
+def init_state_backend():
+    """Выбирает хранилище состояния согласно STATE_BACKEND"""
+    global state_backend
+    
+    if STATE_BACKEND == "sqlite":
+        try:
+            backend = SQLiteStateBackend(STATE_DB_FILE)
+            backend.start()
+            state_backend = backend
+            print(f"✅ Состояние хранится в локальной базе {STATE_DB_FILE}")
+        except Exception as e:
+            print(f"❌ Ошибка открытия {STATE_DB_FILE}, используется Google Drive: {e}")
+            state_backend = DriveStateBackend()
+            state_backend.start()
+    else:
+        state_backend = DriveStateBackend()
+        state_backend.start()
+    
+    atexit.register(lambda: state_backend.flush())
+
+# ========== СИСТЕМА ОТЛОЖЕННЫХ ЗАДАЧ ==========
+class DelayedTaskScheduler:
+    """Планировщик: один поток-диспетчер с кучей по времени запуска и ограниченный пул исполнителей"""
+    
+    def __init__(self, runner, committer, max_workers):
+        self.runner = runner  # runner(task_id) -> изменения статуса задачи или None
+        self.committer = committer  # committer({task_id: изменения}) - одна запись на пачку
+        self.heap = []  # [время запуска, порядковый номер, task_id]; task_id=None - отмененная запись
+        self.entries = {}  # task_id -> запись в куче
+        self.commits = []  # куча (срок сохранения, порядковый номер, пачка) для пачек с готовыми результатами
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="delayed-task")
+        self.started = False
+    
+    def schedule(self, task_id, run_at):
+        """Ставит задачу на время run_at (timestamp); повторный вызов переносит ее"""
+        with self.condition:
+            self.cancel(task_id)
+            entry = [run_at, next(self.counter), task_id]
+            self.entries[task_id] = entry
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.condition.notify()
+        self.start()
+    
+    def cancel(self, task_id):
+        """Отменяет запуск задачи; False, если ее нет в очереди"""
+        with self.condition:
+            entry = self.entries.pop(task_id, None)
+            if entry is None:
+                return False
+            entry[2] = None
+            return True
+    
+    def is_scheduled(self, task_id):
+        """Проверяет, ждет ли задача запуска"""
+        with self.condition:
+            return task_id in self.entries
+    
+    def pending_count(self):
+        """Возвращает количество задач в очереди"""
+        with self.condition:
+            return len(self.entries)
+    
+    def start(self):
+        """Запускает поток-диспетчер, если он еще не запущен"""
+        with self.condition:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self.dispatch_loop, daemon=True).start()
+    
+    def dispatch_loop(self):
+        """Ждет ближайшую задачу или срок сохранения результатов; наступившие задачи передает в пул исполнителей"""
+        while True:
+            with self.condition:
+                while True:
+                    now = time.time()
+                    deadlines = [entry[0] for entry in self.heap[:1] + self.commits[:1]]
+                    if deadlines and min(deadlines) <= now:
+                        break
+                    self.condition.wait(min(deadlines) - now if deadlines else None)
+                
+                # Задачи, наступающие в пределах окна, выполняются одной пачкой
+                due = []
+                if self.heap and self.heap[0][0] <= now:
+                    batch_until = now + SCHEDULER_BATCH_WINDOW
+                    while self.heap and self.heap[0][0] <= batch_until:
+                        run_at, _, task_id = heapq.heappop(self.heap)
+                        if task_id is not None:
+                            del self.entries[task_id]
+                            due.append(task_id)
+                
+                commits = []
+                while self.commits and self.commits[0][0] <= now:
+                    commits.append(heapq.heappop(self.commits)[2])
+            
+            for batch in commits:
+                self.commit_results(batch)
+            if due:
+                self.run_batch(due)
+    
+    def run_batch(self, task_ids):
+        """Выполняет наступившие вместе задачи в пуле; их статусы сохраняются одной записью"""
+        batch = {"results": {}, "remaining": len(task_ids), "commit_scheduled": False, "lock": threading.Lock()}
+        for task_id in task_ids:
+            future = self.executor.submit(self.runner, task_id)
+            future.add_done_callback(lambda future, task_id=task_id: self.task_done(batch, task_id, future))
+    
+    def task_done(self, batch, task_id, future):
+        """Запоминает результат задачи; сохраняет пачку, когда готовы все задачи или истек SCHEDULER_COMMIT_DELAY"""
+        try:
+            changes = future.result()
+        except Exception as e:
+            print(f"❌ Ошибка выполнения отложенной задачи {task_id}: {e}")
+            changes = {"status": "failed", "error": str(e)}
+        
+        with batch["lock"]:
+            if changes:
+                batch["results"][task_id] = changes
+            batch["remaining"] -= 1
+            finished = not batch["remaining"]
+            schedule_commit = not finished and bool(batch["results"]) and not batch["commit_scheduled"]
+            if schedule_commit:
+                batch["commit_scheduled"] = True
+        
+        if finished:
+            self.commit_results(batch)
+        elif schedule_commit:
+            # Долгая задача пачки (например, EMAIL рассылка) не задерживает сохранение уже выполненных:
+            # иначе после сбоя они выполнились бы повторно
+            with self.condition:
+                heapq.heappush(self.commits, (time.time() + SCHEDULER_COMMIT_DELAY, next(self.counter), batch))
+                self.condition.notify()
+    
+    def commit_results(self, batch):
+        """Сохраняет накопленные результаты пачки одной записью"""
+        with batch["lock"]:
+            results = batch["results"]
+            batch["results"] = {}
+            batch["commit_scheduled"] = False
+        
+        if results:
+            try:
+                self.committer(results)
+            except Exception as e:
+                print(f"❌ Ошибка сохранения статусов отложенных задач: {e}")
 
 def add_delayed_task(task_type, target_id, message, delay_seconds, user_id, additional_data=None):
     """Добавляет отложенную задачу"""
-    tasks = load_delayed_tasks()
-    
     task = {
         "id": str(uuid.uuid4()),
         "type": task_type,
@@ -463,28 +2116,19 @@ def add_delayed_task(task_type, target_id, message, delay_seconds, user_id, addi
         "additional_data": additional_data or {}
     }
     
-    tasks["tasks"].append(task)
-    save_delayed_tasks(tasks)
+    state_backend.add_delayed_task(task)
     
-    threading.Timer(delay_seconds, execute_delayed_task, args=[task["id"]]).start()
+    task_scheduler.schedule(task["id"], time.time() + delay_seconds)
     
     log_event("DELAYED_TASK_ADDED", user_id, f"Type: {task_type}, Delay: {delay_seconds} sec")
     return task["id"]
 
 def execute_delayed_task(task_id):
-    """Выполняет отложенную задачу"""
-    tasks = load_delayed_tasks()
-    task = None
-    task_index = -1
-    
-    for i, t in enumerate(tasks["tasks"]):
-        if t["id"] == task_id and t["status"] == "scheduled":
-            task = t
-            task_index = i
-            break
+    """Выполняет отложенную задачу и возвращает изменения ее статуса (None - задача не выполнялась)"""
+    task = state_backend.get_delayed_task(task_id)
     
-    if not task:
-        return
+    if not task or task["status"] != "scheduled":
+        return None
     
     try:
         if task["type"] == "platon_message":
@@ -498,44 +2142,156 @@ def execute_delayed_task(task_id):
         
         elif task["type"] == "email_broadcast":
             emails = task["target_id"] if isinstance(task["target_id"], list) else [task["target_id"]]
-            success_count = 0
-            
-            for email in emails:
-                if send_email(email, "Новости от E-Genius AI", task["message"]):
-                    success_count += 1
-                time.sleep(1)
+            # id рассылки привязан к задаче: повторное выполнение задачи после сбоя досылает ту же рассылку
+            success_count, fail_count = send_email_broadcast(emails, "Новости от E-Genius AI", task["message"],
+                                                             task["created_by"], broadcast_id=f"task_{task['id']}")
             
             log_event("DELAYED_EMAIL_SENT", task["created_by"], f"Emails: {success_count}/{len(emails)}")
         
-        tasks["tasks"][task_index]["status"] = "completed"
-        tasks["tasks"][task_index]["completed_at"] = datetime.now().isoformat()
+        changes = {"status": "completed", "completed_at": datetime.now().isoformat()}
         
     except Exception as e:
         print(f"❌ Ошибка выполнения отложенной задачи: {e}")
-        tasks["tasks"][task_index]["status"] = "failed"
-        tasks["tasks"][task_index]["error"] = str(e)
+        changes = {"status": "failed", "error": str(e)}
+    
+    return changes
+
+def commit_delayed_task_results(changes_by_id):
+    """Сохраняет статусы выполненных за один тик задач одной записью"""
+    state_backend.update_delayed_tasks(changes_by_id)
+
+def restore_delayed_tasks():
+    """Восстанавливает отложенные задачи при запуске бота; просроченные - по политике OVERDUE_TASK_POLICY"""
+    now = time.time()
+    restored = 0
+    overdue = []
+    dropped = {}
     
-    save_delayed_tasks(tasks)
+    for task in state_backend.get_delayed_tasks():
+        if task["status"] != "scheduled":
+            continue
+        
+        try:
+            run_at = datetime.fromisoformat(task["scheduled_time"]).timestamp()
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"❌ Ошибка восстановления задачи: {e}")
+            continue
+        
+        if run_at > now:
+            task_scheduler.schedule(task["id"], run_at)
+            restored += 1
+        elif OVERDUE_TASK_POLICY == "drop" or now - run_at > OVERDUE_GRACE_PERIOD:
+            dropped[task["id"]] = {"status": "overdue"}
+        else:
+            overdue.append((run_at, task["id"]))
+    
+    # Просроченные задачи запускаются в порядке их исходного времени
+    overdue.sort()
+    for position, (run_at, task_id) in enumerate(overdue):
+        delay = position * OVERDUE_STAGGER_INTERVAL if OVERDUE_TASK_POLICY == "stagger" else 0
+        task_scheduler.schedule(task_id, now + delay)
+    
+    if dropped:
+        state_backend.update_delayed_tasks(dropped)
+    
+    print(f"✅ Отложенные задачи: восстановлено {restored}, просроченных к запуску {len(overdue)}, "
+          f"пропущено {len(dropped)}")
+
+task_scheduler = DelayedTaskScheduler(execute_delayed_task, commit_delayed_task_results, SCHEDULER_WORKERS)
+
+# ========== АРХИВАЦИЯ СТАРЫХ ЗАПИСЕЙ ==========
+# Выполненные задачи и команды ПК старше RETENTION_DAYS переносятся из рабочих файлов
+# в сжатые архивы по месяцам (<имя>_archive_ГГГГ-ММ.json.gz в папке бота)
+retention_lock = threading.Lock()
+retention_stats = {"last_run": None, "tasks": 0, "commands": 0, "broadcasts": 0, "bytes": 0, "archives": []}
 
-def restore_delayed_tasks():
-    """Восстанавливает отложенные задачи при запуске бота"""
-    tasks = load_delayed_tasks()
-    current_time = datetime.now()
+def get_entry_date(entry, *fields):
+    """Возвращает первую заполненную дату записи из перечисленных полей"""
+    for field in fields:
+        try:
+            return datetime.fromisoformat(entry[field])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+def archive_entries(service, filename, entries, date_fields):
+    """Дописывает записи в месячные архивы и возвращает имена обновленных архивов"""
+    by_month = {}
+    for entry in entries:
+        by_month.setdefault(get_entry_date(entry, *date_fields).strftime("%Y-%m"), []).append(entry)
+    
+    archives = []
+    for month, items in sorted(by_month.items()):
+        archive_name = f"{os.path.splitext(filename)[0]}_archive_{month}.json.gz"
+        archive_meta = get_drive_file_meta(service, archive_name, GOOGLE_DRIVE_FOLDER_ID)
+        archived = decode_json_content(download_drive_file(service, archive_meta['id']))["items"] if archive_meta else []
+        
+        # Повторная архивация после сбоя не дублирует записи
+        archived_ids = {item.get("id") for item in archived}
+        archived.extend(item for item in items if item.get("id") not in archived_ids)
+        
+        content = gzip.compress(json.dumps({"items": archived}, ensure_ascii=False).encode('utf-8'), mtime=0)
+        upload_file_to_drive(service, archive_name, content, GOOGLE_DRIVE_FOLDER_ID, 'application/gzip')
+        archives.append(archive_name)
+    
+    return archives
+
+def run_retention_pass():
+    """Архивирует старые выполненные задачи, команды ПК и рассылки и возвращает отчет"""
+    service = get_drive_service()
+    if not service or not GOOGLE_DRIVE_FOLDER_ID:
+        return None
     
-    for task in tasks["tasks"]:
-        if task["status"] == "scheduled":
+    cutoff = datetime.now() - timedelta(days=RETENTION_DAYS)
+    collections = [
+        (DELAYED_TASKS_FILE, "tasks", state_backend.get_delayed_tasks, state_backend.remove_delayed_tasks,
+         lambda task: task.get("status") != "scheduled", ("completed_at", "scheduled_time", "created_at")),
+        (PC_COMMANDS_FILE, "commands", state_backend.get_pc_commands, state_backend.remove_pc_commands,
+         lambda command: command.get("status") != "pending", ("completed_at", "created_at")),
+        (EMAIL_OUTBOX_FILE, "broadcasts", state_backend.get_email_broadcasts, state_backend.remove_email_broadcasts,
+         lambda broadcast: broadcast.get("status") == "completed", ("completed_at", "created_at"))
+    ]
+    report = {"last_run": datetime.now().isoformat(), "tasks": 0, "commands": 0, "broadcasts": 0, "bytes": 0,
+              "archives": []}
+    
+    with retention_lock:
+        for filename, key, get_entries, remove_entries, is_finished, date_fields in collections:
             try:
-                scheduled_time = datetime.fromisoformat(task["scheduled_time"])
-                delay_seconds = (scheduled_time - current_time).total_seconds()
+                entries = get_entries()
+                expired = [entry for entry in entries if is_finished(entry)
+                           and (get_entry_date(entry, *date_fields) or datetime.now()) < cutoff]
+                if not expired:
+                    continue
                 
-                if delay_seconds > 0:
-                    threading.Timer(delay_seconds, execute_delayed_task, args=[task["id"]]).start()
-                    print(f"✅ Восстановлена отложенная задача: {task['type']} (через {delay_seconds:.0f} сек)")
-                else:
-                    task["status"] = "overdue"
-                    save_delayed_tasks(tasks)
+                # Сначала архив, затем удаление: при сбое записи остаются в рабочем файле
+                report["archives"].extend(archive_entries(service, filename, expired, date_fields))
+                expired_ids = {entry.get("id") for entry in expired}
+                remove_entries(expired_ids)
+                
+                kept = [entry for entry in entries if entry.get("id") not in expired_ids]
+                report[key] = len(expired)
+                report["bytes"] += (len(encode_json_content(filename, {key: entries})[0])
+                                    - len(encode_json_content(filename, {key: kept})[0]))
             except Exception as e:
-                print(f"❌ Ошибка восстановления задачи: {e}")
+                print(f"❌ Ошибка архивации {filename}: {e}")
+    
+    retention_stats.update(report)
+    if report["tasks"] or report["commands"] or report["broadcasts"]:
+        print(f"🗄️ Архивация: задач {report['tasks']}, команд ПК {report['commands']}, рассылок {report['broadcasts']}, "
+              f"освобождено {report['bytes']} байт ({', '.join(report['archives'])})")
+    return report
+
+def retention_scheduler():
+    """Фоновый поток: архивация вскоре после запуска и затем раз в RETENTION_INTERVAL секунд"""
+    # Первый проход не ждет полного интервала: бот, перезапускаемый чаще раза в сутки, иначе не архивировал бы ничего
+    delay = RETENTION_STARTUP_DELAY
+    while True:
+        time.sleep(delay)
+        delay = RETENTION_INTERVAL
+        try:
+            run_retention_pass()
+        except Exception as e:
+            print(f"Ошибка в планировщике архивации: {e}")
 
 # ========== НАСТРОЙКИ ВЕБ-ПРИЛОЖЕНИЯ ПЛАТОНА ==========
 def load_platon_app_settings():
@@ -555,9 +2311,12 @@ def is_platon_app_enabled():
 
 def toggle_platon_app(enabled):
     """Включает/выключает веб-приложение Платона"""
-    settings = load_platon_app_settings()
-    settings["enabled"] = enabled
-    save_platon_app_settings(settings)
+    def set_enabled(settings):
+        settings["enabled"] = enabled
+        settings["last_updated"] = datetime.now().isoformat()
+        return True
+    
+    update_json_file(PLATON_APP_FILE, {"enabled": True, "last_updated": None}, set_enabled)
     
     if not enabled:
         revoke_all_platon_tokens()
@@ -577,67 +2336,380 @@ def toggle_platon_app(enabled):
     return True
 
 # ========== РАБОТА С БАЗОЙ ДАННЫХ chats.db ==========
-def load_chats_db():
-    """Загружает базу данных chats.db из Google Drive"""
+def save_chats_db(db_content):
+    """Сохраняет базу данных chats.db в Google Drive"""
+    service = get_drive_service()
+    if not service or not GOOGLE_DRIVE_FOLDER_ID:
+        return False
+    
+    # save_binary_file_to_drive сам перехватывает ошибки загрузки и возвращает None
+    file_id = save_binary_file_to_drive(service, CHATS_DB_FILE, db_content, GOOGLE_DRIVE_FOLDER_ID, 'application/x-sqlite3')
+    return file_id is not None
+
+# Основная копия chats.db - локальный файл в режиме WAL с постоянным соединением.
+# В Google Drive лежит полный снимок и небольшие файлы изменений (chats_delta_*.json.gz)
+# из таблицы chats_changelog; восстановление = снимок + изменения после него
+chats_db_conn = None
+chats_db_lock = threading.RLock()
+chats_db_dirty = threading.Event()
+chats_db_syncer_started = False
+# Копия chats.db из Drive в памяти: чтение, если локальная база недоступна
+chats_replica = {"conn": None, "version": None, "checked_at": 0}
+
+def migrate_chats_schema(conn):
+    """Миграция 1: таблица chats, журнал изменений и служебные значения синхронизации"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            chat_title TEXT NOT NULL,
+            chat_username TEXT,
+            chat_type TEXT,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_user ON chats (user_id, last_updated)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chats_changelog (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            chat_title TEXT NOT NULL,
+            chat_username TEXT,
+            chat_type TEXT,
+            last_updated TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE TABLE IF NOT EXISTS chats_sync_meta (key TEXT PRIMARY KEY, value TEXT)")
+
+def migrate_chats_unique_index(conn):
+    """Миграция 2: уникальный индекс (user_id, chat_id); из дублей остается последняя запись"""
+    conn.execute("DELETE FROM chats WHERE id NOT IN (SELECT MAX(id) FROM chats GROUP BY user_id, chat_id)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chats_user_chat ON chats (user_id, chat_id)")
+
+def migrate_legacy_user_chats(conn):
+    """Миграция 3: перенос записей из старой таблицы user_chats в chats"""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_chats'").fetchone():
+        return
+    
+    moved = conn.execute(
+        "INSERT INTO chats (user_id, chat_id, chat_title, chat_username) "
+        "SELECT user_id, chat_id, COALESCE(chat_title, ''), chat_username FROM user_chats WHERE true "
+        "ON CONFLICT(user_id, chat_id) DO NOTHING"
+    ).rowcount
+    conn.execute("DROP TABLE user_chats")
+    print(f"✅ Из user_chats перенесено чатов: {moved}")
+
+# (версия, миграция); версия базы хранится в PRAGMA user_version
+CHATS_DB_MIGRATIONS = [
+    (1, migrate_chats_schema),
+    (2, migrate_chats_unique_index),
+    (3, migrate_legacy_user_chats),
+]
+
+def migrate_chats_db(conn):
+    """Применяет к chats.db миграции новее ее версии, каждую в отдельной транзакции"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    
+    for target_version, migration in CHATS_DB_MIGRATIONS:
+        if target_version <= version:
+            continue
+        
+        try:
+            conn.execute("BEGIN")
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target_version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"✅ chats.db: применена миграция {target_version}")
+
+def restore_chats_db_file():
+    """Собирает локальную chats.db из снимка и файлов изменений в Drive; файл появляется только после успешного восстановления"""
     service = get_drive_service()
     if not service or not GOOGLE_DRIVE_FOLDER_ID:
+        raise sqlite3.OperationalError("Google Drive недоступен, chats.db не восстановлена")
+    
+    temp_path = CHATS_DB_FILE + ".restore"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    
+    conn = sqlite3.connect(temp_path)
+    try:
+        # None - файла в Drive нет (первый запуск); ошибка скачивания - исключение
+        try:
+            db_content = call_with_drive_file_id(service, CHATS_DB_FILE, GOOGLE_DRIVE_FOLDER_ID,
+                                                 lambda file_id: download_drive_file(service, file_id))
+        except Exception as e:
+            raise sqlite3.OperationalError(f"не удалось скачать chats.db из Google Drive: {e}")
+        
+        if db_content is not None:
+            # Скачанная база проверяется в памяти и копируется в файл через backup
+            snapshot = deserialize_chats_db(db_content)
+            if not snapshot:
+                raise sqlite3.OperationalError("снимок chats.db в Google Drive поврежден")
+            snapshot.backup(conn)
+            snapshot.close()
+        
+        migrate_chats_db(conn)
+        apply_chats_deltas(conn)
+        conn.close()
+    except Exception:
+        conn.close()
+        os.remove(temp_path)
+        raise
+    
+    os.replace(temp_path, CHATS_DB_FILE)
+    if db_content is not None:
+        print("✅ База данных chats.db восстановлена из Google Drive")
+
+def get_chats_db():
+    """Возвращает соединение с локальной chats.db (при первом запуске восстанавливает ее из Drive)"""
+    global chats_db_conn
+    
+    with chats_db_lock:
+        if chats_db_conn is not None:
+            return chats_db_conn
+        
+        # Пока восстановление не удалось, локального файла нет и оно повторяется при следующем обращении
+        if not os.path.exists(CHATS_DB_FILE) or os.path.getsize(CHATS_DB_FILE) == 0:
+            restore_chats_db_file()
+        
+        conn = sqlite3.connect(CHATS_DB_FILE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        migrate_chats_db(conn)
+        chats_db_conn = conn
+        return conn
+
+def deserialize_chats_db(db_content):
+    """Открывает скачанную chats.db в памяти без записи на диск (None, если файла нет или он поврежден)"""
+    if not db_content or not db_content.startswith(b'SQLite format 3\x00'):
         return None
     
-    db_content = load_binary_file_from_drive(service, CHATS_DB_FILE, GOOGLE_DRIVE_FOLDER_ID)
-    return db_content
+    # Копия в памяти не может работать в режиме WAL - байты 18-19 заголовка сбрасываются
+    db_content = bytearray(db_content)
+    db_content[18:20] = b'\x01\x01'
+    
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    try:
+        conn.deserialize(bytes(db_content))
+        if conn.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+            raise sqlite3.DatabaseError("проверка целостности не пройдена")
+    except sqlite3.DatabaseError as e:
+        print(f"❌ База данных chats.db из Google Drive повреждена: {e}")
+        conn.close()
+        return None
+    return conn
 
-def save_chats_db(db_content):
-    """Сохраняет базу данных chats.db в Google Drive"""
+def get_chats_replica():
+    """Возвращает копию chats.db из Drive в памяти только для чтения (обновляется при новой ревизии)"""
+    with chats_db_lock:
+        if chats_replica["conn"] and time.time() - chats_replica["checked_at"] < JSON_CACHE_TTL:
+            return chats_replica["conn"]
+    
     service = get_drive_service()
     if not service or not GOOGLE_DRIVE_FOLDER_ID:
-        return False
+        return chats_replica["conn"]
+    
+    file_meta = get_drive_file_meta(service, CHATS_DB_FILE, GOOGLE_DRIVE_FOLDER_ID)
+    if not file_meta:
+        return chats_replica["conn"]
+    
+    version = (file_meta.get("headRevisionId"), tuple(list_indexed_drive_files(GOOGLE_DRIVE_FOLDER_ID, CHATS_DELTA_PREFIX)))
+    with chats_db_lock:
+        if chats_replica["conn"] and chats_replica["version"] == version:
+            chats_replica["checked_at"] = time.time()
+            return chats_replica["conn"]
+    
+    conn = deserialize_chats_db(download_drive_file(service, file_meta['id']))
+    if not conn:
+        return chats_replica["conn"]
+    migrate_chats_db(conn)
+    apply_chats_deltas(conn)
+    conn.execute("PRAGMA query_only=ON")
+    
+    with chats_db_lock:
+        if chats_replica["conn"]:
+            chats_replica["conn"].close()
+        chats_replica.update({"conn": conn, "version": version, "checked_at": time.time()})
+    return conn
+
+def get_chats_sync_meta(conn, key, default=None):
+    """Читает служебное значение синхронизации chats.db"""
+    row = conn.execute("SELECT value FROM chats_sync_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_chats_sync_meta(conn, key, value):
+    """Записывает служебное значение синхронизации chats.db"""
+    conn.execute(
+        "INSERT INTO chats_sync_meta (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, str(value))
+    )
+
+def upsert_chat(conn, user_id, chat_id, chat_title, chat_username, chat_type, last_updated=None):
+    """Добавляет или обновляет чат (last_updated=None - текущее время)"""
+    conn.execute(
+        "INSERT INTO chats (user_id, chat_id, chat_title, chat_username, chat_type, last_updated) "
+        "VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP)) "
+        "ON CONFLICT(user_id, chat_id) DO UPDATE SET chat_title = excluded.chat_title, "
+        "chat_username = excluded.chat_username, chat_type = excluded.chat_type, "
+        "last_updated = excluded.last_updated",
+        (user_id, chat_id, chat_title, chat_username, chat_type, last_updated)
+    )
+
+def apply_chats_deltas(conn):
+    """Применяет к восстановленному снимку файлы изменений, выгруженные после него"""
+    service = get_drive_service()
+    if not service or not GOOGLE_DRIVE_FOLDER_ID:
+        return
+    
+    snapshot_seq = int(get_chats_sync_meta(conn, "snapshot_seq", 0))
+    last_seq = snapshot_seq
+    applied = 0
+    
+    with conn:
+        for delta_name in list_indexed_drive_files(GOOGLE_DRIVE_FOLDER_ID, CHATS_DELTA_PREFIX):
+            # Ошибка скачивания прерывает применение: пропущенный файл потерял бы изменения
+            content = call_with_drive_file_id(service, delta_name, GOOGLE_DRIVE_FOLDER_ID,
+                                              lambda file_id: download_drive_file(service, file_id))
+            if not content:
+                continue
+            
+            delta = decode_json_content(content)
+            if delta["to_seq"] <= snapshot_seq:
+                continue
+            
+            for change in delta["changes"]:
+                if change["seq"] <= last_seq:
+                    continue
+                upsert_chat(conn, change["user_id"], change["chat_id"], change["chat_title"],
+                            change["chat_username"], change["chat_type"], change["last_updated"])
+                last_seq = change["seq"]
+                applied += 1
+        
+        # Новые изменения продолжают нумерацию после уже выгруженных
+        conn.execute("DELETE FROM chats_changelog")
+        conn.execute("INSERT OR IGNORE INTO sqlite_sequence (name, seq) VALUES ('chats_changelog', 0)")
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'chats_changelog'", (last_seq,))
+        set_chats_sync_meta(conn, "uploaded_seq", last_seq)
+    
+    if applied:
+        print(f"✅ К chats.db применено изменений из Google Drive: {applied}")
+
+def serialize_chats_db():
+    """Возвращает согласованную копию chats.db для выгрузки в Drive и номер последнего изменения в ней"""
+    with chats_db_lock:
+        conn = get_chats_db()
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chats_changelog'").fetchone()
+        snapshot_seq = row[0] if row else 0
+        with conn:
+            set_chats_sync_meta(conn, "snapshot_seq", snapshot_seq)
+        content = bytearray(conn.serialize())
+    
+    # Байты 18-19 заголовка: копия в Drive хранится в обычном (не WAL) формате
+    content[18:20] = b'\x01\x01'
+    return bytes(content), snapshot_seq
+
+def upload_chats_delta(service):
+    """Выгружает еще не выгруженные изменения chats.db одним небольшим файлом"""
+    with chats_db_lock:
+        conn = get_chats_db()
+        uploaded_seq = int(get_chats_sync_meta(conn, "uploaded_seq", 0))
+        rows = conn.execute(
+            "SELECT seq, user_id, chat_id, chat_title, chat_username, chat_type, last_updated "
+            "FROM chats_changelog WHERE seq > ? ORDER BY seq",
+            (uploaded_seq,)
+        ).fetchall()
+    
+    if not rows:
+        return
     
+    columns = ("seq", "user_id", "chat_id", "chat_title", "chat_username", "chat_type", "last_updated")
+    delta = {"from_seq": rows[0][0], "to_seq": rows[-1][0], "changes": [dict(zip(columns, row)) for row in rows]}
+    delta_name = f"{CHATS_DELTA_PREFIX}{delta['from_seq']:010d}-{delta['to_seq']:010d}.json.gz"
+    content = gzip.compress(json.dumps(delta, ensure_ascii=False).encode('utf-8'), mtime=0)
+    upload_file_to_drive(service, delta_name, content, GOOGLE_DRIVE_FOLDER_ID, 'application/gzip')
+    
+    with chats_db_lock:
+        with conn:
+            conn.execute("DELETE FROM chats_changelog WHERE seq <= ?", (delta["to_seq"],))
+            set_chats_sync_meta(conn, "uploaded_seq", delta["to_seq"])
+
+def compact_chats_db(service):
+    """Выгружает полный снимок chats.db и удаляет вошедшие в него файлы изменений"""
+    content, snapshot_seq = serialize_chats_db()
+    # Файлы изменений удаляются только после того, как снимок точно загружен
+    if not save_chats_db(content):
+        raise RuntimeError("снимок chats.db не выгружен")
+    
+    for delta_name in list_indexed_drive_files(GOOGLE_DRIVE_FOLDER_ID, CHATS_DELTA_PREFIX):
+        if int(delta_name[len(CHATS_DELTA_PREFIX):].split('-')[1].split('.')[0]) <= snapshot_seq:
+            delete_drive_file(service, delta_name, GOOGLE_DRIVE_FOLDER_ID)
+
+def sync_chats_db():
+    """Выгружает изменения chats.db в Google Drive (при накоплении файлов изменений - полный снимок)"""
+    if not chats_db_dirty.is_set():
+        return True
+    
+    chats_db_dirty.clear()
     try:
-        save_binary_file_to_drive(service, CHATS_DB_FILE, db_content, GOOGLE_DRIVE_FOLDER_ID, 'application/x-sqlite3')
+        service = get_drive_service()
+        if not service or not GOOGLE_DRIVE_FOLDER_ID:
+            raise RuntimeError("Google Drive недоступен")
+        
+        upload_chats_delta(service)
+        if (not find_drive_file_id(service, CHATS_DB_FILE, GOOGLE_DRIVE_FOLDER_ID)
+                or len(list_indexed_drive_files(GOOGLE_DRIVE_FOLDER_ID, CHATS_DELTA_PREFIX)) >= CHATS_DB_COMPACT_DELTAS):
+            compact_chats_db(service)
         return True
     except Exception as e:
-        print(f"❌ Ошибка сохранения базы данных: {e}")
-        return False
+        print(f"❌ Ошибка синхронизации chats.db: {e}")
+    
+    chats_db_dirty.set()
+    return False
+
+def chats_db_syncer():
+    """Фоновый поток: выгрузка изменений chats.db не чаще раза в CHATS_DB_SYNC_INTERVAL секунд"""
+    while True:
+        chats_db_dirty.wait()
+        time.sleep(CHATS_DB_SYNC_INTERVAL)
+        sync_chats_db()
+
+def start_chats_db_syncer():
+    """Запускает поток синхронизации chats.db, если он еще не запущен"""
+    global chats_db_syncer_started
+    
+    with chats_db_lock:
+        if chats_db_syncer_started:
+            return
+        chats_db_syncer_started = True
+    
+    threading.Thread(target=chats_db_syncer, daemon=True).start()
+    atexit.register(sync_chats_db)
 
 def get_user_chats_from_db(user_id):
     """Получает чаты пользователя из базы данных"""
     try:
-        db_content = load_chats_db()
-        
-        if not db_content or not db_content.startswith(b'SQLite format 3\x00'):
-            print("❌ База данных chats.db не найдена или повреждена")
-            return []
-        
-        temp_file = "temp_chats.db"
-        with open(temp_file, 'wb') as f:
-            f.write(db_content)
-        
-        conn = sqlite3.connect(temp_file)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = [row[0] for row in cursor.fetchall()]
-        
-        if 'chats' in tables:
-            cursor.execute(
+        try:
+            conn = get_chats_db()
+        except sqlite3.Error as e:
+            print(f"⚠️ Локальная chats.db недоступна, чтение из копии Google Drive: {e}")
+            conn = get_chats_replica()
+            if not conn:
+                return []
+        
+        with chats_db_lock:
+            result = conn.execute(
                 "SELECT chat_id, chat_title, chat_username FROM chats WHERE user_id = ? ORDER BY last_updated DESC",
                 (user_id,)
-            )
-            result = cursor.fetchall()
-        elif 'user_chats' in tables:
-            cursor.execute(
-                "SELECT chat_id, chat_title, chat_username FROM user_chats WHERE user_id = ?",
-                (user_id,)
-            )
-            result = cursor.fetchall()
-        else:
-            result = []
-        
-        conn.close()
-        os.remove(temp_file)
+            ).fetchall()
         
         return result
-        
+    
     except Exception as e:
         print(f"❌ Ошибка получения чатов: {e}")
         return []
@@ -645,107 +2717,34 @@ def get_user_chats_from_db(user_id):
 def save_chat_to_db(user_id, chat_id, chat_title, chat_username=None, chat_type=None):
     """Сохраняет информацию о чате в базу данных"""
     try:
-        db_content = load_chats_db()
-        
-        temp_file = "temp_save.db"
-        
-        if not db_content or not db_content.startswith(b'SQLite format 3\x00'):
-            conn = sqlite3.connect(temp_file)
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE chats (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    chat_id INTEGER NOT NULL,
-                    chat_title TEXT NOT NULL,
-                    chat_username TEXT,
-                    chat_type TEXT,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        with chats_db_lock:
+            conn = get_chats_db()
+            with conn:
+                upsert_chat(conn, user_id, chat_id, chat_title, chat_username, chat_type)
+                conn.execute(
+                    "INSERT INTO chats_changelog (user_id, chat_id, chat_title, chat_username, chat_type, last_updated) "
+                    "SELECT user_id, chat_id, chat_title, chat_username, chat_type, last_updated "
+                    "FROM chats WHERE user_id = ? AND chat_id = ?",
+                    (user_id, chat_id)
                 )
-            ''')
-        else:
-            with open(temp_file, 'wb') as f:
-                f.write(db_content)
-            
-            conn = sqlite3.connect(temp_file)
-            cursor = conn.cursor()
-            
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='chats'")
-            if not cursor.fetchone():
-                cursor.execute('''
-                    CREATE TABLE chats (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        chat_id INTEGER NOT NULL,
-                        chat_title TEXT NOT NULL,
-                        chat_username TEXT,
-                        chat_type TEXT,
-                        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-        
-        cursor.execute(
-            "SELECT id FROM chats WHERE user_id = ? AND chat_id = ?",
-            (user_id, chat_id)
-        )
-        existing = cursor.fetchone()
-        
-        if existing:
-            cursor.execute(
-                "UPDATE chats SET chat_title = ?, chat_username = ?, chat_type = ?, last_updated = CURRENT_TIMESTAMP WHERE id = ?",
-                (chat_title, chat_username, chat_type, existing[0])
-            )
-        else:
-            cursor.execute(
-                "INSERT INTO chats (user_id, chat_id, chat_title, chat_username, chat_type) VALUES (?, ?, ?, ?, ?)",
-                (user_id, chat_id, chat_title, chat_username, chat_type)
-            )
-        
-        conn.commit()
-        
-        with open(temp_file, 'rb') as f:
-            new_db_content = f.read()
-        
-        save_chats_db(new_db_content)
-        
-        conn.close()
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
         
+        chats_db_dirty.set()
+        start_chats_db_syncer()
         return True
-        
+    
     except Exception as e:
         print(f"❌ Ошибка сохранения чата: {e}")
-        if os.path.exists('temp_save.db'):
-            os.remove('temp_save.db')
         return False
 
 def init_chats_database():
     """Инициализирует базу данных чатов"""
     try:
-        db_content = load_chats_db()
-        
-        if db_content and db_content.startswith(b'SQLite format 3\x00'):
-            print("✅ База данных chats.db загружена из Google Drive")
-            
-            temp_file = "temp_check.db"
-            with open(temp_file, 'wb') as f:
-                f.write(db_content)
-            
-            conn = sqlite3.connect(temp_file)
-            cursor = conn.cursor()
-            
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = [row[0] for row in cursor.fetchall()]
-            print(f"📊 Найдено таблиц: {tables}")
-            
-            conn.close()
-            os.remove(temp_file)
-            return True
-        else:
-            print("❌ База данных chats.db не найдена, будет создана при необходимости")
-            return False
-            
+        with chats_db_lock:
+            tables = [row[0] for row in get_chats_db().execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        print(f"✅ База данных chats.db открыта, найдено таблиц: {tables}")
+        start_chats_db_syncer()
+        return True
+    
     except Exception as e:
         print(f"❌ Ошибка работы с базой данных: {e}")
         return False
@@ -753,174 +2752,101 @@ def init_chats_database():
 # ========== ФУНКЦИИ ДЛЯ РАБОТЫ С ДАННЫМИ ==========
 def get_user_emails(user_id):
     """Получает email пользователя"""
-    emails_data = load_json_file(EMAILS_FILE, {"emails": []})
-    
-    if not isinstance(emails_data, dict) or "emails" not in emails_data:
-        emails_data = {"emails": []}
-    
-    user_emails = [email["email"] for email in emails_data["emails"] if email["user_id"] == user_id]
-    return user_emails
+    return [item["email"] for item in state_backend.get_emails(user_id)]
 
 def get_all_emails():
     """Получает все email"""
-    emails_data = load_json_file(EMAILS_FILE, {"emails": []})
-    
-    if not isinstance(emails_data, dict) or "emails" not in emails_data:
-        emails_data = {"emails": []}
-    
-    emails = list(set([email["email"] for email in emails_data["emails"]]))
+    emails = list(set([item["email"] for item in state_backend.get_emails()]))
     return emails
 
 def get_emails_with_users():
     """Получает все email с информацией о пользователях"""
-    emails_data = load_json_file(EMAILS_FILE, {"emails": []})
-    
-    if not isinstance(emails_data, dict) or "emails" not in emails_data:
-        emails_data = {"emails": []}
-    
     result = []
-    for item in emails_data["emails"]:
+    for item in state_backend.get_emails():
         result.append({
             "user_id": item["user_id"],
             "email": item["email"],
-            "added_date": item.get("added_date", "Unknown")
+            "added_date": item.get("added_date") or "Unknown"
         })
     
     return result
 
 def save_user_email(user_id, email):
     """Сохраняет email пользователя"""
-    emails_data = load_json_file(EMAILS_FILE, {"emails": []})
-    
-    if not isinstance(emails_data, dict):
-        emails_data = {"emails": []}
-    if "emails" not in emails_data:
-        emails_data["emails"] = []
-    
-    for item in emails_data["emails"]:
-        if item["user_id"] == user_id and item["email"] == email:
-            return False
-    
-    emails_data["emails"].append({
-        "user_id": user_id,
-        "email": email,
-        "added_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    })
+    if not state_backend.add_email(user_id, email, datetime.now().strftime("%Y-%m-%d %H:%M:%S")):
+        return False
     
-    save_json_file(EMAILS_FILE, emails_data)
     log_event("EMAIL_ADDED", user_id, f"Email: {email}")
     return True
 
 def delete_email_by_admin(email):
     """Уделяет email"""
-    emails_data = load_json_file(EMAILS_FILE, {"emails": []})
-    
-    if not isinstance(emails_data, dict) or "emails" not in emails_data:
-        return False
-    
-    original_count = len(emails_data["emails"])
-    emails_data["emails"] = [item for item in emails_data["emails"] if item["email"] != email]
-    
-    if len(emails_data["emails"]) < original_count:
-        save_json_file(EMAILS_FILE, emails_data)
-        return True
-    
-    return False
+    return state_backend.delete_email(email)
+
+# user_id -> роль (первая из назначенных, как в get_user_type); сбрасывается при внешнем
+# изменении auth_users.json и перестраивается не реже, чем обновляется кэш JSON файлов
+auth_roles = {"roles": None, "built_at": 0}
+auth_roles_lock = threading.Lock()
+
+def invalidate_auth_roles():
+    """Сбрасывает индекс ролей"""
+    with auth_roles_lock:
+        auth_roles["roles"] = None
+
+def get_auth_roles():
+    """Возвращает индекс ролей, при необходимости перестраивая его"""
+    with auth_roles_lock:
+        roles = auth_roles["roles"]
+        if roles is not None and (is_drive_changes_active() or time.time() - auth_roles["built_at"] < JSON_CACHE_TTL):
+            return roles
+    
+    roles = {}
+    for user in state_backend.get_auth_users():
+        roles.setdefault(user["user_id"], user["user_type"])
+    
+    with auth_roles_lock:
+        auth_roles["roles"] = roles
+        auth_roles["built_at"] = time.time()
+    return roles
 
 def check_user_access(user_id):
     """Проверяет доступ пользователя"""
-    auth_data = load_json_file(AUTH_USERS_FILE, {"users": []})
-    
-    if not isinstance(auth_data, dict) or "users" not in auth_data:
-        auth_data = {"users": []}
-    
-    for user in auth_data["users"]:
-        if user["user_id"] == user_id:
-            return user["user_type"]
-    
-    return None
+    return get_auth_roles().get(user_id)
 
 def save_auth_user(user_type, user_id):
     """Сохраняет авторизованного пользователя"""
-    auth_data = load_json_file(AUTH_USERS_FILE, {"users": []})
-    
-    if not isinstance(auth_data, dict):
-        auth_data = {"users": []}
-    if "users" not in auth_data:
-        auth_data["users"] = []
-    
-    user_exists = False
-    for user in auth_data["users"]:
-        if user["user_id"] == user_id and user["user_type"] == user_type:
-            user_exists = True
-            break
-    
-    if not user_exists:
-        auth_data["users"].append({
-            "user_id": user_id,
-            "user_type": user_type,
-            "added_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
-        
-        save_json_file(AUTH_USERS_FILE, auth_data)
+    if state_backend.add_auth_user(user_type, user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")):
+        with auth_roles_lock:
+            if auth_roles["roles"] is not None:
+                auth_roles["roles"].setdefault(user_id, user_type)
         log_event("AUTH_ADDED", user_id, f"Type: {user_type}")
     
     return True
 
 def get_all_users():
     """Получает всех пользователей"""
-    emails_data = load_json_file(EMAILS_FILE, {"emails": []})
-    auth_data = load_json_file(AUTH_USERS_FILE, {"users": []})
-    
-    if not isinstance(emails_data, dict) or "emails" not in emails_data:
-        emails_data = {"emails": []}
-    if not isinstance(auth_data, dict) or "users" not in auth_data:
-        auth_data = {"users": []}
-    
     all_users = set()
     
-    for email_item in emails_data["emails"]:
+    for email_item in state_backend.get_emails():
         all_users.add(email_item["user_id"])
     
-    for auth_user in auth_data["users"]:
+    for auth_user in state_backend.get_auth_users():
         all_users.add(auth_user["user_id"])
     
     return list(all_users)
 
 def get_platon_users():
     """Получает всех пользователей Платон"""
-    auth_data = load_json_file(AUTH_USERS_FILE, {"users": []})
-    
-    if not isinstance(auth_data, dict) or "users" not in auth_data:
-        auth_data = {"users": []}
-    
-    platon_users = [user["user_id"] for user in auth_data["users"] if user["user_type"] == "platon"]
-    return platon_users
+    return [user["user_id"] for user in state_backend.get_auth_users("platon")]
 
 def save_setting(key, value):
     """Сохраняет настройку"""
-    settings_data = load_json_file(SETTINGS_FILE, {"settings": {}})
-    
-    if not isinstance(settings_data, dict):
-        settings_data = {"settings": {}}
-    if "settings" not in settings_data:
-        settings_data["settings"] = {}
-    
-    settings_data["settings"][key] = value
-    save_json_file(SETTINGS_FILE, settings_data)
+    state_backend.set_setting(key, value)
     return True
 
 def load_setting(key, default=None):
     """Загружает настройку"""
-    settings_data = load_json_file(SETTINGS_FILE, {"settings": {}})
-    
-    if not isinstance(settings_data, dict) or "settings" not in settings_data:
-        return default
-    
-    if key in settings_data["settings"]:
-        return settings_data["settings"][key]
-    
-    return default
+    return state_backend.get_setting(key, default)
 
 # ========== OPENROUTER API ==========
 def ask_openrouter(user_message):
@@ -990,6 +2916,116 @@ def handle_ai_request(user_id, user_message):
     return response
 
 # ========== EMAIL ФУНКЦИИ ==========
+class SMTPConnectionPool:
+    """Пул авторизованных SMTP сессий: сессии переиспользуются между письмами, одновременно - не больше max_sessions"""
+    
+    def __init__(self, max_sessions, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(max_sessions)
+        self.idle = []  # [(сессия, время последнего использования)]
+        self.lock = threading.Lock()
+    
+    def connect(self):
+        """Открывает новую сессию: соединение, STARTTLS и вход"""
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        try:
+            if SMTP_STARTTLS:
+                server.starttls()
+            server.ehlo_or_helo_if_needed()
+            if server.has_extn("auth"):
+                server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+        except Exception:
+            self.close_session(server)
+            raise
+        return server
+    
+    def acquire(self):
+        """Берет свободную сессию из пула или открывает новую"""
+        self.slots.acquire()
+        try:
+            with self.lock:
+                while self.idle:
+                    server, last_used = self.idle.pop()
+                    if time.time() - last_used < self.idle_timeout:
+                        return server
+                    self.close_session(server)
+            return self.connect()
+        except Exception:
+            self.slots.release()
+            raise
+    
+    def release(self, server, broken=False):
+        """Возвращает сессию в пул (broken - закрывает ее)"""
+        if broken:
+            self.close_session(server)
+        else:
+            with self.lock:
+                self.idle.append((server, time.time()))
+        self.slots.release()
+    
+    def close_session(self, server):
+        """Закрывает сессию, не обращая внимания на ошибки"""
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+    
+    def send(self, action):
+        """Выполняет action(server) на сессии из пула; если сервер разорвал соединение - повторяет на новой"""
+        for attempt in range(2):
+            server = self.acquire()
+            try:
+                result = action(server)
+            except smtplib.SMTPServerDisconnected:
+                self.release(server, broken=True)
+                if attempt:
+                    raise
+                continue
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                # Сервер отклонил письмо, но сессия осталась рабочей
+                self.release(server)
+                raise
+            except Exception:
+                self.release(server, broken=True)
+                raise
+            
+            self.release(server)
+            return result
+    
+    def close_all(self):
+        """Закрывает все свободные сессии"""
+        with self.lock:
+            sessions, self.idle = self.idle, []
+        for server, last_used in sessions:
+            self.close_session(server)
+
+smtp_pool = SMTPConnectionPool(SMTP_MAX_SESSIONS, SMTP_IDLE_TIMEOUT)
+atexit.register(smtp_pool.close_all)
+
+# Так же, как письмо сериализует SMTP.send_message: заголовки compat32, строки через CRLF
+email_wire_policy = compat32.clone(linesep="\r\n")
+
+def render_email(subject, message_text):
+    """Собирает письмо без заголовка To и возвращает его байты (для рассылки - один раз на всех получателей)"""
+    msg = MIMEMultipart()
+    msg['From'] = EMAIL_SENDER
+    msg['Subject'] = subject
+    msg.attach(MIMEText(message_text, 'plain'))
+    return msg.as_bytes(policy=email_wire_policy)
+
+def deliver_rendered_email(to_email, payload):
+    """Отправляет собранное письмо, дописав к нему заголовок To; ошибки SMTP не перехватываются"""
+    raw_message = email_wire_policy.fold_binary("To", to_email) + payload
+    smtp_pool.send(lambda server: server.sendmail(EMAIL_SENDER, [to_email], raw_message))
+    print(f"✅ Email отправлен на {to_email}")
+
+def deliver_email(to_email, subject, message_text):
+    """Отправляет email; ошибки SMTP не перехватываются"""
+    deliver_rendered_email(to_email, render_email(subject, message_text))
+
 def send_email(to_email, subject, message_text):
     """Отправляет email"""
     if not EMAIL_SENDER or not EMAIL_PASSWORD:
@@ -997,53 +3033,228 @@ def send_email(to_email, subject, message_text):
         return False
         
     try:
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL_SENDER
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(message_text, 'plain'))
-        
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        print(f"✅ Email отправлен на {to_email}")
+        deliver_email(to_email, subject, message_text)
         return True
     except Exception as e:
         print(f"❌ Ошибка отправки email: {e}")
         return False
 
+def is_temporary_email_error(error):
+    """Проверяет, стоит ли повторить отправку: коды 4xx, разрыв соединения, сетевые ошибки и таймауты"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, message in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPException):
+        return isinstance(error, smtplib.SMTPServerDisconnected)
+    return isinstance(error, OSError)
+
+# ========== РАССЫЛКА EMAIL ==========
+class TokenBucketLimiter:
+    """Ограничитель скорости из нескольких корзин токенов; limits() возвращает [(сообщений, за секунд)], 0 - без ограничения"""
+    
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}  # период -> [токенов, время пополнения]
+        self.lock = threading.Lock()
+    
+    def try_acquire(self):
+        """Забирает токен из каждой корзины; возвращает 0 или сколько секунд ждать следующего токена"""
+        with self.lock:
+            now = time.time()
+            limits = [(rate, period) for rate, period in self.limits() if rate]
+            wait = 0
+            for rate, period in limits:
+                bucket = self.buckets.setdefault(period, [rate, now])
+                bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate / period)
+                bucket[1] = now
+                if bucket[0] < 1:
+                    wait = max(wait, (1 - bucket[0]) * period / rate)
+            
+            if wait:
+                return wait
+            for rate, period in limits:
+                self.buckets[period][0] -= 1
+            return 0
+    
+    def acquire(self, max_wait):
+        """Ждет разрешения на отправку; False - если ждать пришлось бы дольше max_wait секунд"""
+        deadline = time.time() + max_wait
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+email_rate_limiter = TokenBucketLimiter(lambda: [
+    (EMAIL_RATE_PER_SECOND, 1),
+    (EMAIL_RATE_PER_MINUTE, 60),
+    (EMAIL_RATE_PER_DAY, 24 * 3600)
+])
+email_broadcast_executor = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="email")
+
+# Рассылка сначала сохраняется в очередь (email_outbox.json) с состоянием доставки каждому
+# получателю, затем доставляется; после перезапуска бота недоставленные письма досылаются,
+# а уже доставленные не отправляются повторно
+broadcast_locks = {}
+broadcast_locks_guard = threading.Lock()
+
+def get_broadcast_lock(broadcast_id):
+    """Возвращает блокировку рассылки: одну рассылку доставляет только один поток"""
+    with broadcast_locks_guard:
+        if broadcast_id not in broadcast_locks:
+            broadcast_locks[broadcast_id] = threading.Lock()
+        return broadcast_locks[broadcast_id]
+
+def send_rate_limited_email(to_email, payload):
+    """Отправляет собранное письмо, дождавшись разрешения ограничителя скорости; возвращает None или ошибку"""
+    if not EMAIL_SENDER or not EMAIL_PASSWORD:
+        return RuntimeError("данные для отправки email не настроены")
+    if not email_rate_limiter.acquire(EMAIL_RATE_MAX_WAIT):
+        return TimeoutError("лимит отправки email исчерпан")
+    
+    try:
+        deliver_rendered_email(to_email, payload)
+        return None
+    except Exception as e:
+        print(f"❌ Ошибка отправки email на {to_email}: {e}")
+        return e
+
+def next_delivery_state(state, error):
+    """Возвращает состояние доставки после попытки: sent, pending (с временем повтора) или failed"""
+    attempts = state.get("attempts", 0) + 1
+    if error is None:
+        return {"status": "sent", "attempts": attempts, "sent_at": datetime.now().isoformat()}
+    if is_temporary_email_error(error) and attempts < EMAIL_MAX_ATTEMPTS:
+        return {"status": "pending", "attempts": attempts, "error": str(error),
+                "next_attempt": time.time() + EMAIL_RETRY_DELAY * 2 ** (attempts - 1)}
+    return {"status": "failed", "attempts": attempts, "error": str(error)}
+
+def count_deliveries(recipients):
+    """Возвращает (обработано, доставлено, не доставлено) по состояниям получателей"""
+    success_count = sum(1 for state in recipients.values() if state["status"] == "sent")
+    fail_count = sum(1 for state in recipients.values() if state["status"] == "failed")
+    return success_count + fail_count, success_count, fail_count
+
+def queue_email_broadcast(emails, subject, message_text, created_by, chat_id=None, broadcast_id=None):
+    """Сохраняет рассылку в очередь и возвращает ее id (если рассылка с broadcast_id уже есть - она не меняется)"""
+    broadcast_id = broadcast_id or f"email_{int(time.time() * 1000)}_{secrets.token_hex(3)}"
+    broadcast = {
+        "id": broadcast_id,
+        "subject": subject,
+        "message": message_text,
+        "created_by": created_by,
+        "chat_id": chat_id,
+        "created_at": datetime.now().isoformat(),
+        "status": "sending",
+        "recipients": {email: {"status": "pending", "attempts": 0} for email in dict.fromkeys(emails)}
+    }
+    if not state_backend.add_email_broadcast(broadcast):
+        return None
+    return broadcast_id
+
+def run_email_broadcast(broadcast_id, progress=None):
+    """Доставляет письма рассылки из очереди (с повторами при временных ошибках); возвращает (успешно, с ошибкой)"""
+    with get_broadcast_lock(broadcast_id):
+        broadcast = state_backend.get_email_broadcast(broadcast_id)
+        if not broadcast:
+            return 0, 0
+        
+        recipients = broadcast["recipients"]
+        payload = render_email(broadcast["subject"], broadcast["message"])
+        last_report = time.time()
+        
+        while True:
+            now = time.time()
+            pending = {email: state for email, state in recipients.items() if state["status"] == "pending"}
+            due = [email for email, state in pending.items() if state.get("next_attempt", 0) <= now]
+            if not due:
+                if not pending:
+                    break
+                time.sleep(min(state["next_attempt"] for state in pending.values()) - now)
+                continue
+            
+            futures = {email_broadcast_executor.submit(send_rate_limited_email, email, payload): email for email in due}
+            for future in as_completed(futures):
+                email = futures[future]
+                recipients[email] = next_delivery_state(recipients[email], future.result())
+                # Результат сохраняется сразу: после сбоя доставленное письмо не уйдет повторно
+                state_backend.update_email_recipients(broadcast_id, {email: recipients[email]})
+                
+                if progress and time.time() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    progress(*count_deliveries(recipients))
+                    last_report = time.time()
+        
+        if broadcast["status"] != "completed":
+            state_backend.update_email_broadcast(broadcast_id, {"status": "completed",
+                                                                "completed_at": datetime.now().isoformat()})
+        
+        return count_deliveries(recipients)[1:]
+
+def send_email_broadcast(emails, subject, message_text, created_by, progress=None, chat_id=None, broadcast_id=None):
+    """Ставит рассылку в очередь и доставляет ее; возвращает (успешно, с ошибкой)"""
+    broadcast_id = queue_email_broadcast(emails, subject, message_text, created_by, chat_id, broadcast_id)
+    if not broadcast_id:
+        print("❌ Не удалось сохранить рассылку в очередь")
+        return 0, len(emails)
+    return run_email_broadcast(broadcast_id, progress)
+
+def resume_email_broadcasts():
+    """Досылает рассылки, прерванные перезапуском бота"""
+    for broadcast in state_backend.get_email_broadcasts():
+        if broadcast["status"] == "completed":
+            continue
+        
+        done = count_deliveries(broadcast["recipients"])[0]
+        print(f"🔄 Возобновляю рассылку {broadcast['id']}: доставлено {done} из {len(broadcast['recipients'])}")
+        
+        try:
+            success_count, fail_count = run_email_broadcast(broadcast["id"])
+            log_event("EMAIL_BROADCAST_RESUMED", broadcast.get("created_by"),
+                      f"Emails: {success_count}/{len(broadcast['recipients'])}")
+            if broadcast.get("chat_id"):
+                bot.send_message(broadcast["chat_id"],
+                                f"<b>✅ EMAIL рассылка, прерванная перезапуском бота, завершена!</b>\n\n"
+                                f"Успешно отправлено: {success_count}\n"
+                                f"Не удалось отправить: {fail_count}")
+        except Exception as e:
+            print(f"❌ Ошибка возобновления рассылки {broadcast['id']}: {e}")
+
+def broadcast_progress_reporter(chat_id, total):
+    """Отправляет сообщение о ходе рассылки и возвращает функцию, обновляющую его"""
+    status_message = bot.send_message(chat_id, f"<b>⏳ Отправлено: 0/{total}</b>")
+    
+    def progress(done, success_count, fail_count):
+        try:
+            bot.edit_message_text(f"<b>⏳ Отправлено: {done}/{total}</b>\n\n"
+                                  f"Успешно: {success_count}\n"
+                                  f"С ошибкой: {fail_count}",
+                                  chat_id, status_message.message_id)
+        except Exception as e:
+            print(f"⚠️ Не удалось обновить ход рассылки: {e}")
+    
+    return progress
+
 # ========== ФУНКЦИИ ДЛЯ УПРАВЛЕНИЯ ПК ==========
 def get_pc_commands():
     """Получает список команд управления ПК"""
-    commands_data = load_json_file(PC_COMMANDS_FILE, {"commands": []})
-    return commands_data.get("commands", [])
+    return state_backend.get_pc_commands()
 
 def save_pc_command(command):
     """Сохраняет команду управления ПК"""
-    commands_data = load_json_file(PC_COMMANDS_FILE, {"commands": []})
-    commands_data["commands"].append(command)
-    return save_json_file(PC_COMMANDS_FILE, commands_data)
+    return state_backend.add_pc_command(command)
 
 def get_pc_status():
-    """Получает статусы всех ПК"""
-    service = get_drive_service()
-    if not service or not GOOGLE_DRIVE_FOLDER_ID:
-        return []
-    
-    content = load_file_from_drive(service, PC_STATUS_FILE, GOOGLE_DRIVE_FOLDER_ID)
-    if not content:
-        return []
+    """Получает статусы всех ПК (файл обновляет агент на ПК, перечитывается по ленте изменений)"""
+    # Файл принадлежит агенту на ПК: если его нет, бот его не создает
+    status_data = load_json_file(PC_STATUS_FILE, [], create_missing=False)
     
-    try:
-        status_data = json.loads(content)
-        if isinstance(status_data, list):
-            return status_data
-        elif isinstance(status_data, dict):
-            return [status_data]
-    except:
-        return []
+    if isinstance(status_data, list):
+        return status_data
+    elif isinstance(status_data, dict):
+        return [status_data]
     
     return []
 
@@ -1073,15 +3284,31 @@ def get_available_pcs():
     pcs = get_pc_status()
     return [pc for pc in pcs if datetime.fromisoformat(pc.get('last_seen', '2000-01-01')).timestamp() > time.time() - 300]
 
+# file_id -> (md5Checksum, metadata) для файлов .meta.json скриншотов
+screenshot_meta_cache = {}
+
+def load_screenshot_meta(service, meta_file):
+    """Возвращает содержимое .meta.json, скачивая его только при изменении md5"""
+    cached = screenshot_meta_cache.get(meta_file['id'])
+    if cached and meta_file.get('md5Checksum') and cached[0] == meta_file['md5Checksum']:
+        return copy.deepcopy(cached[1])
+    
+    metadata = json.loads(download_drive_file(service, meta_file['id']).decode('utf-8'))
+    screenshot_meta_cache[meta_file['id']] = (meta_file.get('md5Checksum'), metadata)
+    return copy.deepcopy(metadata)
+
 def check_screenshots(user_id):
     """Проверяет и отправляет новые скриншоты"""
     service = get_drive_service()
     if not service or not GOOGLE_DRIVE_FOLDER_ID or not SCREENSHOTS_FOLDER_ID:
         return []
     
+    # Один запрос со списком файлов и их md5 заменяет отдельную загрузку каждого .meta.json
     query = f"'{SCREENSHOTS_FOLDER_ID}' in parents and trashed=false"
-    results = service.files().list(q=query, fields='files(id, name, mimeType, createdTime)').execute()
+    results = service.files().list(q=query, fields='files(id, name, mimeType, createdTime, md5Checksum)').execute()
     files = results.get('files', [])
+    remember_drive_files(SCREENSHOTS_FOLDER_ID, files)
+    meta_files = {file['name']: file for file in files if file['name'].endswith('.meta.json')}
     
     screenshots_sent = []
     
@@ -1090,11 +3317,11 @@ def check_screenshots(user_id):
             filename = file['name']
             
             meta_filename = f"{filename}.meta.json"
-            meta_content = load_file_from_drive(service, meta_filename, SCREENSHOTS_FOLDER_ID)
+            meta_file = meta_files.get(meta_filename)
             
-            if meta_content:
+            if meta_file:
                 try:
-                    metadata = json.loads(meta_content)
+                    metadata = load_screenshot_meta(service, meta_file)
                     
                     if metadata.get('status') == 'new':
                         request = service.files().get_media(fileId=file['id'])
@@ -1118,9 +3345,10 @@ def check_screenshots(user_id):
                         metadata['sent_to'] = user_id
                         metadata['sent_at'] = datetime.now().isoformat()
                         
-                        save_file_to_drive(service, meta_filename, 
-                                          json.dumps(metadata, indent=2, ensure_ascii=False),
-                                          SCREENSHOTS_FOLDER_ID)
+                        meta_content = json.dumps(metadata, indent=2, ensure_ascii=False)
+                        saved_meta = upload_file_to_drive(service, meta_filename, meta_content.encode('utf-8'),
+                                                          SCREENSHOTS_FOLDER_ID, 'application/json')
+                        screenshot_meta_cache[saved_meta['id']] = (saved_meta.get('md5Checksum'), metadata)
                         
                         screenshots_sent.append(filename)
                         log_event("SCREENSHOT_SENT", user_id, f"File: {filename}")
@@ -1148,7 +3376,18 @@ def load_config_from_drive():
             "PASSWORD_PLATON": "платон_пароль",
             "OPENROUTER_KEY": "sk-or-v1-ваш_ключ_openrouter",
             "EMAIL_SENDER": "ваш_email@gmail.com",
-            "EMAIL_PASSWORD": "ваш_пароль_приложения"
+            "EMAIL_PASSWORD": "ваш_пароль_приложения",
+            "STATE_BACKEND": "drive",
+            "STATE_FILE_ENCODING": "json",
+            "RETENTION_DAYS": 30,
+            "OVERDUE_TASK_POLICY": "stagger",
+            "OVERDUE_GRACE_PERIOD": 21600,
+            "SMTP_HOST": "smtp.gmail.com",
+            "SMTP_PORT": 587,
+            "SMTP_STARTTLS": True,
+            "EMAIL_RATE_PER_SECOND": 2,
+            "EMAIL_RATE_PER_MINUTE": 60,
+            "EMAIL_RATE_PER_DAY": 2000
         }
         
         save_file_to_drive(service, CONFIG_FILE, json.dumps(example_config, indent=2, ensure_ascii=False), GOOGLE_DRIVE_FOLDER_ID)
@@ -1159,7 +3398,9 @@ def load_config_from_drive():
     try:
         config = json.loads(content)
         
-        global BOT_TOKEN, PASSWORD_ADMIN, PASSWORD_PLATON, OPENROUTER_KEY, EMAIL_SENDER, EMAIL_PASSWORD
+        global BOT_TOKEN, PASSWORD_ADMIN, PASSWORD_PLATON, OPENROUTER_KEY, EMAIL_SENDER, EMAIL_PASSWORD, STATE_BACKEND
+        global STATE_FILE_ENCODING, RETENTION_DAYS, OVERDUE_TASK_POLICY, OVERDUE_GRACE_PERIOD
+        global SMTP_HOST, SMTP_PORT, SMTP_STARTTLS, EMAIL_RATE_PER_SECOND, EMAIL_RATE_PER_MINUTE, EMAIL_RATE_PER_DAY
         
         BOT_TOKEN = config.get("BOT_TOKEN")
         PASSWORD_ADMIN = config.get("PASSWORD_ADMIN")
@@ -1167,6 +3408,19 @@ def load_config_from_drive():
         OPENROUTER_KEY = config.get("OPENROUTER_KEY")
         EMAIL_SENDER = config.get("EMAIL_SENDER")
         EMAIL_PASSWORD = config.get("EMAIL_PASSWORD")
+        STATE_BACKEND = config.get("STATE_BACKEND", "drive")
+        STATE_FILE_ENCODING = config.get("STATE_FILE_ENCODING", "json")
+        RETENTION_DAYS = config.get("RETENTION_DAYS", 30)
+        OVERDUE_TASK_POLICY = config.get("OVERDUE_TASK_POLICY", "stagger")
+        OVERDUE_GRACE_PERIOD = config.get("OVERDUE_GRACE_PERIOD", 6 * 3600)
+        SMTP_HOST = config.get("SMTP_HOST", "smtp.gmail.com")
+        SMTP_PORT = config.get("SMTP_PORT", 587)
+        SMTP_STARTTLS = config.get("SMTP_STARTTLS", True)
+        EMAIL_RATE_PER_SECOND = config.get("EMAIL_RATE_PER_SECOND", 2)
+        EMAIL_RATE_PER_MINUTE = config.get("EMAIL_RATE_PER_MINUTE", 60)
+        EMAIL_RATE_PER_DAY = config.get("EMAIL_RATE_PER_DAY", 2000)
+        if STATE_FILE_ENCODING == "msgpack-gz" and msgpack is None:
+            print("⚠️ Модуль msgpack не установлен, файлы состояния будут сохраняться как json-gz")
         
         if not all([BOT_TOKEN, PASSWORD_ADMIN, PASSWORD_PLATON]):
             print("❌ Не все обязательные настройки заполнены в config.json")
@@ -1192,6 +3446,7 @@ def initialize_system():
     if not service:
         print("❌ Не удалось подключиться к Google Drive")
         return False
+    start_drive_token_refresher()
     
     global GOOGLE_DRIVE_FOLDER_ID
     query = f"name='{FOLDER_NAME}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
@@ -1213,6 +3468,19 @@ def initialize_system():
     global SCREENSHOTS_FOLDER_ID
     SCREENSHOTS_FOLDER_ID = get_or_create_folder(service, SCREENSHOTS_FOLDER, GOOGLE_DRIVE_FOLDER_ID)
     
+    load_drive_index()
+    try:
+        index_drive_folder(service, GOOGLE_DRIVE_FOLDER_ID)
+        if SCREENSHOTS_FOLDER_ID:
+            index_drive_folder(service, SCREENSHOTS_FOLDER_ID)
+    except Exception as e:
+        print(f"⚠️ Ошибка индексации файлов Google Drive: {e}")
+    
+    try:
+        start_drive_changes_watcher(service)
+    except Exception as e:
+        print(f"⚠️ Ошибка запуска ленты изменений Google Drive: {e}")
+    
     if not load_config_from_drive():
         print("❌ Не удалось загрузить конфигурацию")
         return False
@@ -1230,11 +3498,31 @@ def initialize_system():
         (DELAYED_TASKS_FILE, {"tasks": []})
     ]
     
+    # Существование известных по индексу файлов проверяется одним batch-запросом,
+    # скачиваются только отсутствующие в индексе или пустые файлы
+    with drive_index_lock:
+        folder_index = dict(drive_file_index.get(GOOGLE_DRIVE_FOLDER_ID, {}))
+    file_ids = {filename: folder_index[filename] for filename, _ in initial_files if filename in folder_index}
+    try:
+        files_meta = batch_get_drive_files_meta(service, file_ids.values())
+    except Exception as e:
+        print(f"⚠️ Ошибка batch-проверки файлов: {e}")
+        files_meta = {}
+    
     for filename, default_data in initial_files:
+        file_meta = files_meta.get(file_ids.get(filename))
+        if file_meta and int(file_meta.get('size', 0)) > 0:
+            continue
+        
         content = load_file_from_drive(service, filename, GOOGLE_DRIVE_FOLDER_ID)
         if not content:
             save_file_to_drive(service, filename, json.dumps(default_data, indent=2, ensure_ascii=False), GOOGLE_DRIVE_FOLDER_ID)
     
+    init_state_backend()
+    invalidate_auth_roles()
+    print(f"✅ Загружено ролей пользователей: {len(get_auth_roles())}")
+    load_token_expiry_index()
+    
     print("✅ Система инициализирована")
     return True
 
@@ -1648,9 +3936,22 @@ def setup_bot_handlers():
         
         markup.add(types.InlineKeyboardButton("🔙 Назад", callback_data="settings_back"))
         
+        flush_stats = get_json_flush_stats()
+        retention_text = "еще не выполнялась"
+        if retention_stats["last_run"]:
+            retention_text = (f"{retention_stats['last_run'][:16].replace('T', ' ')}, "
+                              f"задач {retention_stats['tasks']}, команд {retention_stats['commands']}, "
+                              f"рассылок {retention_stats['broadcasts']}, "
+                              f"освобождено {retention_stats['bytes']} байт")
+        
         bot.send_message(message.chat.id,
                         "<b>⚙️ Настройки бота</b>\n\n"
-                        "Здесь вы можете настроить различные функции бота.",
+                        "Здесь вы можете настроить различные функции бота.\n\n"
+                        f"💾 Синхронизация с Google Drive: сохранений {flush_stats['saves']}, "
+                        f"загрузок {flush_stats['uploads']}, "
+                        f"в очереди {flush_stats['pending_files']} ф. ({flush_stats['pending_bytes']} байт), "
+                        f"последняя загрузка {flush_stats['last_latency']:.2f} с\n"
+                        f"🗄️ Архивация: {retention_text}",
                         reply_markup=markup)
 
     @bot.message_handler(func=lambda message: message.text == "🖥️ Управление ПК")
@@ -1745,7 +4046,7 @@ def setup_bot_handlers():
         
         elif call.data == "admin_email_stats":
             emails = get_all_emails()
-            emails_data = load_json_file(EMAILS_FILE, {"emails": []})
+            emails_data = {"emails": get_emails_with_users()}
             unique_users = len(set([email["user_id"] for email in emails_data.get("emails", [])]))
             
             response = f"""<b>📊 Статистика email</b>
@@ -2655,15 +4956,11 @@ def process_email_broadcast(message):
                         f"Сообщение: {broadcast_message[:50]}...\n"
                         f"Количество получателей: {len(emails)}")
         
-        success_count = 0
-        fail_count = 0
-        
-        for email in emails:
-            if send_email(email, "Новости от E-Genius AI", broadcast_message):
-                success_count += 1
-            else:
-                fail_count += 1
-            time.sleep(1)
+        success_count, fail_count = send_email_broadcast(
+            emails, "Новости от E-Genius AI", broadcast_message, message.from_user.id,
+            progress=broadcast_progress_reporter(message.chat.id, len(emails)),
+            chat_id=message.chat.id
+        )
         
         bot.send_message(message.chat.id,
                         f"<b>✅ EMAIL рассылка завершена!</b>\n\n"
@@ -2709,15 +5006,11 @@ def process_selective_email(message):
                         f"<b>📧 Начинаю выборочную рассылку...</b>\n\n"
                         f"Получателей: {len(selected_emails)}")
         
-        success_count = 0
-        fail_count = 0
-        
-        for email in selected_emails:
-            if send_email(email, "Новости от E-Genius AI", message.text):
-                success_count += 1
-            else:
-                fail_count += 1
-            time.sleep(1)
+        success_count, fail_count = send_email_broadcast(
+            selected_emails, "Новости от E-Genius AI", message.text, user_id,
+            progress=broadcast_progress_reporter(message.chat.id, len(selected_emails)),
+            chat_id=message.chat.id
+        )
         
         bot.send_message(message.chat.id,
                         f"<b>✅ Выборочная рассылка завершена!</b>\n\n"
@@ -2877,6 +5170,9 @@ if __name__ == "__main__":
     
     restore_delayed_tasks()
     
+    # Досылаем EMAIL рассылки, прерванные перезапуском
+    threading.Thread(target=resume_email_broadcasts, daemon=True).start()
+    
     # Очищаем просроченные токены при запуске
     expired_count = cleanup_expired_tokens()
     if expired_count > 0:
@@ -2884,36 +5180,29 @@ if __name__ == "__main__":
     
     # Запускаем проверку скриншотов в отдельном потоке
     def screenshot_checker():
-        """Проверяет новые скриншоты каждые 30 секунд"""
+        """Проверяет новые скриншоты при изменениях в папке (без ленты изменений - каждые 30 секунд)"""
         while True:
             try:
-                auth_data = load_json_file(AUTH_USERS_FILE, {"users": []})
-                admins = [user["user_id"] for user in auth_data.get("users", []) 
-                         if user["user_type"] == "admin"]
+                changed = screenshots_changed.wait(30)
+                screenshots_changed.clear()
+                if not changed and is_drive_changes_active():
+                    continue
+                
+                admins = [user["user_id"] for user in state_backend.get_auth_users("admin")]
                 
                 for admin_id in admins:
                     check_screenshots(admin_id)
-                
-                time.sleep(30)
             except Exception as e:
                 print(f"Ошибка в проверке скриншотов: {e}")
                 time.sleep(30)
     
     threading.Thread(target=screenshot_checker, daemon=True).start()
     
-    # Запускаем очистку токенов каждые 6 часов
-    def token_cleanup_scheduler():
-        """Очищает просроченные токены каждые 6 часов"""
-        while True:
-            try:
-                time.sleep(6 * 3600)  # 6 часов
-                expired_count = cleanup_expired_tokens()
-                if expired_count > 0:
-                    print(f"🔄 Автоматическая очистка: удалено {expired_count} просроченных токенов")
-            except Exception as e:
-                print(f"Ошибка в планировщике очистки токенов: {e}")
+    # Удаляем токены по мере истечения
+    threading.Thread(target=token_expiry_scheduler, daemon=True).start()
     
-    threading.Thread(target=token_cleanup_scheduler, daemon=True).start()
+    # Архивируем выполненные задачи и команды ПК после запуска и раз в сутки
+    threading.Thread(target=retention_scheduler, daemon=True).start()
     
     print(f"\n{'=' * 60}")
     print("🎯 ОСНОВНЫЕ ФУНКЦИИ БОТА:")